@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod, abstractproperty, abstractstaticmethod
 from typing import Tuple
+import numpy as np
 
 ActionTuple = Tuple[int, int, int]
 
@@ -31,3 +32,11 @@ class Action(ABC):
     @abstractstaticmethod
     def from_action_tuple(action_tuple: ActionTuple) -> 'Action':
         pass
+
+    @property
+    def flat_index(self) -> int:
+        return int(np.ravel_multi_index(self.action_tuple, self.get_shape()))
+
+    @classmethod
+    def from_flat_index(cls, index: int) -> 'Action':
+        return cls.from_action_tuple(np.unravel_index(index, cls.get_shape()))
@@ -1,13 +1,10 @@
-from collections import deque
-from typing import Dict, Tuple
+from logging import DEBUG
+from typing import List, Optional, Tuple
 from action import Action, ActionTuple
 import numpy as np
-from chess import Move, QUEEN, Color, BLACK
+from chess import Move, Color, BLACK, WHITE
 from chess_rules.chess_square import ChessSquare
 from logger import get_logger
-from threading import Lock
-
-cache_lock = Lock()
 
 logger = get_logger(__name__)
 
@@ -48,11 +45,8 @@ underpromotion_moves = [ # 3 for each direction
 for i, direction in enumerate(underpromotion_moves):
     underpromotion_moves[i] = ChessSquare(*direction)
 
-action_map: Dict[ActionTuple, 'ChessAction'] = {}
-max_actions = 1000000
-action_stores = deque([], maxlen=max_actions)
-
-eps = 1E-8
+# promotion piece -> last index of the move table, queen promotions are plain queen moves
+promotion_slots = [0, 0, 1, 2, 3, 0, 0] # None/pawn, knight, bishop, rook, queen, king
 
 class ChessAction:
     def __init__(self, action_tuple: ActionTuple, from_creator=False):
@@ -60,35 +54,32 @@ class ChessAction:
             logger.critical("NOT CREATED FROM CREATOR!")
             assert False
         self._action_tuple = action_tuple
+        self._flat_index = int(np.ravel_multi_index(action_tuple, ChessAction.get_shape()))
+        self._hash = int(np.dot(action_tuple, (1, 8, 64)))
         self.parse_move()
 
     @staticmethod
     def from_action_tuple(action_tuple: ActionTuple) -> 'ChessAction':     
-        action_tuple = tuple(int(x) for x in action_tuple)
-        if action_tuple in action_map:
-            return action_map[action_tuple]
+        x, y, p = action_tuple
+        return actions[(int(x) * 8 + int(y)) * 73 + int(p)]
 
-        cache_lock.aquire()
-        if len(action_stores) + 1 >= max_actions:
-            at = action_stores.popleft()
-            del action_map[at]
-        cache_lock.release()
-
-        new_chess_action = ChessAction(action_tuple, from_creator=True)
-        action_map[action_tuple] = new_chess_action
-        action_stores.append(action_tuple)
-        return new_chess_action
+    @staticmethod
+    def from_flat_index(index: int) -> 'ChessAction':
+        return actions[index]
 
     def parse_move(self):
-        logger.debug("parsing move {}".format(self.action_tuple))
+        # runs for every action while the tables are built, so the messages are only
+        # formatted when debug logging is actually on
+        debug = logger.isEnabledFor(DEBUG)
+        if debug:
+            logger.debug("parsing move {}".format(self.action_tuple))
         x, y, p = self.action_tuple
         self._action_type = p
         self._starting_square: ChessSquare = ChessSquare(x, y)
-        logger.debug("starting square is {}".format(self._starting_square))
         self._move_type = self._get_move_type()
-        logger.debug("move type is {}".format(self._move_type))
         self._to_square: ChessSquare = self._get_to_square()
-        logger.debug("ending square {}".format(self._to_square))
+        if debug:
+            logger.debug("starting square {}, move type {}, ending square {}".format(self._starting_square, self._move_type, self._to_square))
 
     def _get_direction(self) -> int:
         if self._move_type == "queen":
@@ -118,13 +109,9 @@ class ChessAction:
 
     def _get_to_square(self) -> ChessSquare:
         direction = self._get_direction()
-        logger.debug("direction is {}".format(direction))
-        logger.debug("direction typpe is {}".format(type(direction)))
 
         if self._move_type == "queen":
             move_amount = queen_directions[direction]
-            logger.debug("queen move dir {}".format(move_amount))
-            logger.debug("queen move amount {}".format(self._get_num_moves()))
             move_amount *= self._get_num_moves()
         elif self._move_type == "knight":
             move_amount = knight_directions[direction]
@@ -135,85 +122,30 @@ class ChessAction:
 
     @staticmethod
     def from_move(move: Move, turn: Color) -> 'ChessAction':
-        x = y = p = 0
+        index = move_to_index[int(turn), move.from_square, move.to_square, promotion_slots[move.promotion or 0]]
+        if index < 0:
+            raise ValueError("move {} has no action".format(move))
 
-        logger.debug("creating action from move {}".format(str(move)))
-
-        from_square = ChessSquare.from_CSquare(move.from_square)
-        logger.debug("start square: {}".format(from_square))
-
-        to_square = ChessSquare.from_CSquare(move.to_square)
-        logger.debug("end square: {}".format(to_square))
-
-        if turn == BLACK:
-            logger.debug("turn is black so flipping...")
-            logger.debug("start before flip {}, after {}".format(from_square, from_square.color_flip()))
-            from_square = from_square.color_flip()
-            logger.debug("end before flip {}, after flip {}".format(to_square, to_square.color_flip()))
-            to_square = to_square.color_flip()
-
-        diff = to_square - from_square
-
-        logger.debug("move has diff of {}".format(diff))
-
-        x = from_square.x
-        y = from_square.y
-
-        if move.promotion == None or move.promotion == QUEEN:
-            slope = abs(diff).slope()
-
-            logger.debug("move slope is {}".format(slope))
-
-            if abs(slope - 0.5) < eps or abs(slope - 2) < eps:
-                # knight move
-                logger.debug("move is knight")
-                direction = knight_directions.index(diff)
-                p += 56 + direction
-            else:
-                # queen move
-                logger.debug("move is queen")
-                diff_a = abs(diff)
-                move_amount = max(diff_a.x, diff_a.y)
-                diff //= move_amount
-                direction = queen_directions.index(diff)
-                p += move_amount + direction * 7 - 1
-        else:
-            p += 64
-
-            logger.debug("move is an underpromotion")
-            move_dir = underpromotion_moves.index(diff)
-            under_prom_type = move.promotion - 2
-
-            p += 3 * move_dir + under_prom_type
-
-        x = int(x)
-        y = int(y)
-        p = int(p)
-
-        logger.debug("creating action with tuple: {}".format((x,y,p)))
-
-        return ChessAction.from_action_tuple((x, y, p))
+        return actions[index]
 
     def to_move(self, turn: Color) -> Move:
-        if not self.is_valid():
+        move = index_to_move[int(turn)][self._flat_index]
+        if move == None:
             logger.critical("action 'invalid' with tuple {} which is from {} to {}".format(self.action_tuple, self._starting_square, self._to_square))
-            return None
+        return move
 
+    def _build_move(self, turn: Color) -> Move:
         flipped_start: ChessSquare = self._starting_square
         flipped_end: ChessSquare = self._to_square
 
         if turn == BLACK:
-            logger.debug("turn is black so flipping...")
-            logger.debug("start before flip {}, after {}".format(flipped_start, flipped_start.color_flip()))
             flipped_start = flipped_start.color_flip()
-            logger.debug("end before flip {}, after flip {}".format(flipped_end, flipped_end.color_flip()))
             flipped_end = flipped_end.color_flip()
 
-
         return Move(flipped_start.chess_square, flipped_end.chess_square, promotion=self._get_promoted_piece()) # get promotion 
 
     def __hash__(self) -> int:
-        return int(np.dot(self.action_tuple, (1, 8, 64)))
+        return self._hash
 
     def __eq__(self, other: Action) -> bool:
         if self is other:
@@ -233,4 +165,50 @@ class ChessAction:
 
     @property
     def action_tuple(self) -> ActionTuple:
-        return self._action_tuple
\ No newline at end of file
+        return self._action_tuple
+
+    @property
+    def flat_index(self) -> int:
+        return self._flat_index
+
+def _build_tables() -> Tuple[List[ChessAction], np.ndarray, List[List[Optional[Move]]]]:
+    # every action exists exactly once, so conversions are lookups instead of square arithmetic
+    shape = ChessAction.get_shape()
+    action_count = int(np.prod(shape))
+
+    all_actions = []
+    move_table = np.full((2, 64, 64, 4), -1, dtype=np.int16) # [turn, from, to, promotion slot]
+    move_list = [[None] * action_count, [None] * action_count] # [turn][flat index]
+
+    for index in range(action_count):
+        action_tuple = tuple(int(x) for x in np.unravel_index(index, shape))
+        action = ChessAction(action_tuple, from_creator=True)
+        all_actions.append(action)
+
+        if not action.is_valid():
+            continue
+
+        for turn in [BLACK, WHITE]:
+            move = action._build_move(turn)
+            move_list[int(turn)][index] = move
+            move_table[int(turn), move.from_square, move.to_square, promotion_slots[move.promotion or 0]] = index
+
+    return all_actions, move_table, move_list
+
+actions, move_to_index, index_to_move = _build_tables()
+
+def _build_mirror_table() -> np.ndarray:
+    # mirror_index[i] is the action that action i becomes when the board is mirrored left to
+    # right, actions that go off the board map to themselves, they never have any probability
+    mirror = np.arange(len(actions))
+    for index, move in enumerate(index_to_move[int(WHITE)]):
+        if move == None:
+            continue
+
+        from_square = move.from_square ^ 7 # flips the file
+        to_square = move.to_square ^ 7
+        mirror[index] = move_to_index[int(WHITE), from_square, to_square, promotion_slots[move.promotion or 0]]
+
+    return mirror
+
+mirror_index = _build_mirror_table()
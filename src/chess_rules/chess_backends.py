@@ -0,0 +1,213 @@
+from abc import ABC, abstractmethod
+from tempfile import TemporaryDirectory
+from threading import Lock
+from typing import Dict, Optional, Tuple, Type
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import Model as KModel
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# a backend runs the forward pass of a keras model for a (batch, *input_shape) float32 array
+# and returns (pis, vs) as numpy, the exported ones copy the weights when they are built so
+# they have to be rebuilt after the weights change
+
+PiV = Tuple[np.ndarray, np.ndarray]
+
+class InferenceBackend(ABC):
+    def __init__(self, model: KModel):
+        self._input_shape = tuple(model.input_shape[1:])
+
+    @abstractmethod
+    def predict(self, x: np.ndarray) -> PiV:
+        pass
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+class KerasBackend(InferenceBackend):
+    # model.predict, builds a data adapter and callbacks on every call
+    def __init__(self, model: KModel):
+        super().__init__(model)
+        self._model = model
+
+    def predict(self, x: np.ndarray) -> PiV:
+        pis, vs = self._model.predict(x, verbose=0)
+        return pis, vs
+
+def _make_function(model: KModel, input_shape: tuple):
+    # one trace for any batch size
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,) + input_shape, dtype=tf.float32)])
+    def forward(x):
+        pis, vs = model(x, training=False)
+        return pis, vs
+
+    return forward
+
+class FunctionBackend(InferenceBackend):
+    # calls the model directly through a tf.function with a fixed input signature, it reads
+    # the model's variables so training does not invalidate it
+    def __init__(self, model: KModel):
+        super().__init__(model)
+        self._forward = _make_function(model, self._input_shape)
+
+    def predict(self, x: np.ndarray) -> PiV:
+        pis, vs = self._forward(tf.convert_to_tensor(x, dtype=tf.float32))
+        return pis.numpy(), vs.numpy()
+
+precisions = ["float32", "float16", "int8"]
+
+def convert_to_tflite(model: KModel, precision: str = "float32", calibration: Optional[np.ndarray] = None) -> bytes:
+    # float16 stores the weights as halves, int8 quantizes weights and activations with ranges
+    # measured on the calibration positions, inputs and outputs stay float32 either way
+    if precision not in precisions:
+        raise ValueError("unknown precision '{}', options are {}".format(precision, precisions))
+
+    # keras 3 models convert to nan outputs unless they are exported with model.export,
+    # older keras has no export and converts fine from a plain saved model
+    with TemporaryDirectory() as saved_model_dir:
+        if hasattr(model, "export"):
+            model.export(saved_model_dir, verbose=False)
+        else:
+            tf.saved_model.save(model, saved_model_dir)
+
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+
+        if precision == "float16":
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif precision == "int8":
+            if calibration is None or len(calibration) == 0:
+                raise ValueError("int8 quantization needs calibration positions")
+
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([calibration[i:i + 1].astype(np.float32)] for i in range(len(calibration)))
+
+        return converter.convert()
+
+class TFLiteBackend(InferenceBackend):
+    # runs a tflite flatbuffer, converted from the model at full precision unless one is given,
+    # meant for cpu self play workers
+    def __init__(self, model: KModel, flatbuffer: Optional[bytes] = None):
+        super().__init__(model)
+        self._flatbuffer = flatbuffer if flatbuffer != None else convert_to_tflite(model)
+
+        self._delegates = True
+        self._make_interpreter()
+        # the interpreter is not thread safe
+        self._lock = Lock()
+
+    def _make_interpreter(self):
+        # the default delegate (xnnpack) fails to prepare some quantized graphs, without it the
+        # builtin kernels run them, see _resize
+        # threads follow tensorflow's intra op setting when there is one, 0 means all cores
+        threads = tf.config.threading.get_intra_op_parallelism_threads()
+        self._interpreter = tf.lite.Interpreter(
+            model_content=self._flatbuffer, 
+            num_threads=threads if threads > 0 else None, 
+            experimental_op_resolver_type=tf.lite.experimental.OpResolverType.AUTO if self._delegates else tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        )
+        self._input_index = self._interpreter.get_input_details()[0]["index"]
+        self._batch_size = None
+
+    def _resize(self, batch_size: int):
+        self._interpreter.resize_tensor_input(self._input_index, (batch_size,) + self._input_shape)
+        try:
+            self._interpreter.allocate_tensors()
+        except RuntimeError as e:
+            if not self._delegates:
+                raise
+
+            logger.warning("tflite delegate failed to prepare, running without it: {}".format(e))
+            self._delegates = False
+            self._make_interpreter()
+            self._resize(batch_size)
+            return
+
+        self._batch_size = batch_size
+
+        # pi is the 4d output, v the 2d one
+        outputs = self._interpreter.get_output_details()
+        self._pi_index = next(output["index"] for output in outputs if len(output["shape"]) == 4)
+        self._v_index = next(output["index"] for output in outputs if len(output["shape"]) == 2)
+
+    def predict(self, x: np.ndarray) -> PiV:
+        with self._lock:
+            if len(x) != self._batch_size:
+                self._resize(len(x))
+
+            self._interpreter.set_tensor(self._input_index, x.astype(np.float32, copy=False))
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._pi_index), self._interpreter.get_tensor(self._v_index)
+
+class OnnxBackend(InferenceBackend):
+    # exports through tf2onnx and runs on onnxruntime, both are optional dependencies
+    def __init__(self, model: KModel):
+        super().__init__(model)
+        try:
+            import onnxruntime
+            import tf2onnx
+        except ImportError as e:
+            raise ImportError("the onnx backend needs the tf2onnx and onnxruntime packages") from e
+
+        forward = _make_function(model, self._input_shape)
+        onnx_model, _ = tf2onnx.convert.from_function(forward, input_signature=forward.input_signature)
+
+        self._session = onnxruntime.InferenceSession(onnx_model.SerializeToString(), providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+        outputs = self._session.get_outputs()
+        self._output_names = [output.name for output in outputs]
+        self._pi_first = len(outputs[0].shape) == 4
+
+    def predict(self, x: np.ndarray) -> PiV:
+        first, second = self._session.run(self._output_names, {self._input_name: x.astype(np.float32, copy=False)})
+        return (first, second) if self._pi_first else (second, first)
+
+backends: Dict[str, Type[InferenceBackend]] = {
+    "keras": KerasBackend,
+    "function": FunctionBackend,
+    "tflite": TFLiteBackend,
+    "onnx": OnnxBackend
+}
+
+def make_backend(name: str, model: KModel) -> InferenceBackend:
+    if name not in backends:
+        raise ValueError("unknown inference backend '{}', options are {}".format(name, list(backends.keys())))
+
+    return backends[name](model)
+
+def check_parity(model: KModel, backend: InferenceBackend, x: np.ndarray) -> Dict[str, float]:
+    # largest absolute difference from the keras model on the same inputs, nan outputs count
+    # as an infinite difference
+    pis, vs = KerasBackend(model).predict(x)
+    backend_pis, backend_vs = backend.predict(x)
+
+    return {
+        "pi_max_abs_diff": float(np.nan_to_num(np.max(np.abs(pis - backend_pis)), nan=np.inf)),
+        "v_max_abs_diff": float(np.nan_to_num(np.max(np.abs(vs - backend_vs)), nan=np.inf))
+    }
+
+def agreement_report(reference: InferenceBackend, candidate: InferenceBackend, x: np.ndarray) -> Dict[str, float]:
+    # how much a reduced precision backend drifts from the full precision one
+    pis, vs = reference.predict(x)
+    candidate_pis, candidate_vs = candidate.predict(x)
+
+    n = len(x)
+    pis = pis.reshape(n, -1)
+    candidate_pis = candidate_pis.reshape(n, -1)
+    vs = vs.ravel()
+    candidate_vs = candidate_vs.ravel()
+
+    eps = 1e-8
+    kl = np.sum(pis * (np.log(pis + eps) - np.log(candidate_pis + eps)), axis=1)
+
+    return {
+        "positions": n,
+        "policy_top1_agreement": float(np.mean(np.argmax(pis, axis=1) == np.argmax(candidate_pis, axis=1))),
+        "policy_mean_kl": float(np.mean(kl)),
+        "policy_max_abs_diff": float(np.max(np.abs(pis - candidate_pis))),
+        "value_mean_abs_diff": float(np.mean(np.abs(vs - candidate_vs))),
+        "value_sign_agreement": float(np.mean(np.sign(vs) == np.sign(candidate_vs)))
+    }
@@ -0,0 +1,308 @@
+import json
+import platform
+import random
+import subprocess
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+import numpy as np
+from chess import Board, Move
+from config_loader import config
+from chess_rules.chess_action import ChessAction
+from chess_rules.chess_pi import ChessPI
+from chess_rules.chess_state import ChessState, state_table
+from action import Action
+from game import Game
+from logger import get_logger
+from evaluator import clear_nn_cache
+from mcts import MCTS
+from model import Model
+from pi import PI
+from replay_buffer import ReplayBuffer
+from self_play import play_game
+from state import State
+
+# run from src with python -m chess_rules.chess_benchmark, prints one json object
+# the benchmarks do not import tensorflow, the network is replaced by StubChessModel, only
+# --parity builds the real network to compare the inference backends with keras
+
+logger = get_logger(__name__)
+
+class StubChessModel(Model):
+    # same fixed policy for every state and a value derived from the position key, so a
+    # search is deterministic and costs nothing on the nn side
+    def __init__(self, seed: int = 0):
+        self._pi = np.random.default_rng(seed).random(ChessAction.get_shape()).astype(np.float32)
+        self._pi /= np.sum(self._pi)
+
+    def predict_pi_v(self, state: State) -> Tuple[PI, float]:
+        return ChessPI.from_pi_dist(self._pi), (hash(state) & 0xFFFF) / 0xFFFF * 2 - 1
+
+    @property
+    def name(self) -> str:
+        return "stub_chess_model"
+
+    def save(self, file_path: str, name: str):
+        pass
+
+    def load(self, file_path: str, name: str):
+        pass
+
+    def clone(self) -> Model:
+        return StubChessModel()
+
+    def train(self, train_data: Model.DataType, test_data: Model.DataType):
+        pass
+
+class BenchmarkGame(Game):
+    @staticmethod
+    def get_state_class() -> Type[State]:
+        return ChessState
+
+    @staticmethod
+    def get_action_class() -> Type[Action]:
+        return ChessAction
+
+    @staticmethod
+    def get_model_class() -> Type[Model]:
+        return StubChessModel
+
+    @staticmethod
+    def get_PI_class() -> Type[PI]:
+        return ChessPI
+
+def _timed(fn: Callable[[], Any], ops: int, repeats: int) -> Dict[str, float]:
+    # best of repeats, ops is how many operations one call of fn does
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+
+    best = min(times)
+    return {
+        "ops": ops,
+        "seconds": best,
+        "ops_per_sec": ops / best if best > 0 else float("inf")
+    }
+
+def _random_positions(count: int, max_moves: int = 120) -> List[Tuple[Board, Move]]:
+    # (board, legal move) pairs from random games, uses the seeded random module
+    out = []
+    while len(out) < count:
+        board = Board()
+        for _ in range(random.randint(0, max_moves)):
+            moves = list(board.legal_moves)
+            if len(moves) == 0:
+                break
+            board.push(random.choice(moves))
+
+        moves = list(board.legal_moves)
+        if len(moves) > 0:
+            out.append((board, random.choice(moves)))
+
+    return out
+
+def bench_get_pi(positions: List[Tuple[Board, Move]], simulations: int, repeats: int) -> Dict[str, float]:
+    states = [ChessState.create_state(board.copy()) for board, _ in positions]
+    nn = StubChessModel()
+
+    def run():
+        state_table.clear()
+        clear_nn_cache()
+        mcts = MCTS(nn, BenchmarkGame)
+        for state in states:
+            mcts.reset()
+            mcts.get_pi(state, 1, True)
+
+    config["simulations"] = simulations
+    result = _timed(run, simulations * len(states), repeats)
+    result["simulations_per_move"] = simulations
+    return result
+
+def bench_take_action(positions: List[Tuple[Board, Move]], repeats: int) -> Dict[str, float]:
+    pairs = [(ChessState.create_state(board.copy()), ChessAction.from_move(move, board.turn)) for board, move in positions]
+
+    def run():
+        state_table.clear()
+        for state, action in pairs:
+            state.take_action(action)
+
+    return _timed(run, len(pairs), repeats)
+
+def bench_create_state(positions: List[Tuple[Board, Move]], repeats: int) -> Dict[str, float]:
+    boards = [board.copy() for board, _ in positions]
+
+    def run():
+        state_table.clear()
+        for board in boards:
+            ChessState.create_state(board)
+
+    return _timed(run, len(boards), repeats)
+
+def bench_from_move(positions: List[Tuple[Board, Move]], repeats: int) -> Dict[str, float]:
+    moves = [(move, board.turn) for board, move in positions]
+
+    def run():
+        for move, turn in moves:
+            ChessAction.from_move(move, turn)
+
+    return _timed(run, len(moves), repeats)
+
+def bench_get_nn_rep(positions: List[Tuple[Board, Move]], repeats: int) -> Dict[str, Any]:
+    states = [ChessState.create_state(board.copy()) for board, _ in positions]
+
+    def single():
+        for state in states:
+            state.get_nn_rep()
+
+    def batched():
+        ChessState.get_nn_reps(states)
+
+    return {
+        "single": _timed(single, len(states), repeats),
+        "batched": _timed(batched, len(states), repeats)
+    }
+
+def bench_data_to_np(positions: List[Tuple[Board, Move]], samples: int, repeats: int) -> Dict[str, float]:
+    buffer = ReplayBuffer(samples, ChessState, ChessAction.get_shape())
+    states = []
+    pis = []
+    vs = []
+
+    for i in range(samples):
+        board, _ = positions[i % len(positions)]
+        state = ChessState.create_state(board.copy())
+        indices = state.legal_action_indices()
+        states.append(state)
+        pis.append(ChessPI.from_sparse_dist(indices, np.full(len(indices), 1 / len(indices))))
+        vs.append(i % 3 - 1)
+
+    buffer.add(states, pis, vs)
+    nn = StubChessModel()
+
+    return _timed(lambda: nn.data_to_np(buffer), samples, repeats)
+
+def bench_self_play(games: int, simulations: int) -> Dict[str, float]:
+    nn = StubChessModel()
+    moves = 0
+
+    def run():
+        nonlocal moves
+        state_table.clear()
+        clear_nn_cache()
+        for _ in range(games):
+            moves += len(play_game(MCTS(nn, BenchmarkGame), BenchmarkGame)[0])
+
+    config["simulations"] = simulations
+    result = _timed(run, 0, 1)
+    result["ops"] = moves
+    result["ops_per_sec"] = moves / result["seconds"]
+    result["games"] = games
+    result["simulations_per_move"] = simulations
+    return result
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run_benchmarks(seed: int = 0, quick: bool = False) -> Dict[str, Any]:
+    random.seed(seed)
+    np.random.seed(seed)
+
+    position_count = 200 if quick else 2000
+    repeats = 1 if quick else 3
+    simulations = 50 if quick else 200
+
+    positions = _random_positions(position_count)
+    search_positions = positions[:5 if quick else 20]
+    default_simulations = config["simulations"]
+
+    results: Dict[str, Any] = {}
+    try:
+        logger.info("benchmarking MCTS.get_pi")
+        results["get_pi"] = bench_get_pi(search_positions, simulations, repeats)
+        logger.info("benchmarking ChessState.take_action")
+        results["take_action"] = bench_take_action(positions, repeats)
+        logger.info("benchmarking ChessState.create_state")
+        results["create_state"] = bench_create_state(positions, repeats)
+        logger.info("benchmarking ChessAction.from_move")
+        results["from_move"] = bench_from_move(positions, repeats)
+        logger.info("benchmarking get_nn_rep")
+        results["get_nn_rep"] = bench_get_nn_rep(positions, repeats)
+        logger.info("benchmarking data_to_np")
+        results["data_to_np"] = bench_data_to_np(positions, 1000 if quick else 10000, repeats)
+        logger.info("benchmarking self play")
+        results["self_play"] = bench_self_play(1, 25 if quick else default_simulations)
+    finally:
+        config["simulations"] = default_simulations
+
+    return {
+        "commit": _commit(),
+        "seed": seed,
+        "quick": quick,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results
+    }
+
+def run_parity(profile: Optional[str] = None, load_path: Optional[str] = None) -> Dict[str, Any]:
+    # every inference backend against keras on the same positions, a backend passes when
+    # neither output differs by more than inference_parity_tolerance
+    from chess_rules.chess_backends import backends
+    from chess_rules.chess_model import ChessModel, get_spec
+
+    nn = ChessModel(get_spec(profile))
+    if load_path != None:
+        nn.load(load_path, "base_nn")
+
+    tolerance = config["inference_parity_tolerance"]
+    results: Dict[str, Any] = {}
+
+    for name in backends:
+        if name == "keras":
+            continue
+
+        logger.info("checking {} parity".format(name))
+        try:
+            diffs: Dict[str, Any] = nn.parity(name)
+        except ImportError as e: # optional backend that is not installed
+            results[name] = {"skipped": str(e)}
+            continue
+
+        diffs["passed"] = diffs["pi_max_abs_diff"] <= tolerance and diffs["v_max_abs_diff"] <= tolerance
+        results[name] = diffs
+
+    return {
+        "commit": _commit(),
+        "spec": nn.spec,
+        "tolerance": tolerance,
+        "results": results
+    }
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="hot path benchmarks with a stub model, results are printed as json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a smoke test")
+    parser.add_argument("--out", type=str, default=None, help="also write the json to this file")
+    parser.add_argument("--parity", action="store_true", help="check the inference backends against keras instead, exits with 1 if one fails")
+    parser.add_argument("--profile", type=str, default=None, help="model profile for --parity, defaults to model_profile")
+    parser.add_argument("--load", type=str, default=None, help="check the base_nn saved in this directory instead of fresh weights")
+    args = parser.parse_args()
+
+    if args.parity:
+        report = run_parity(args.profile, args.load)
+    else:
+        report = run_benchmarks(args.seed, args.quick)
+
+    text = json.dumps(report, indent=4)
+    print(text)
+
+    if args.out != None:
+        with open(args.out, "w") as file:
+            file.write(text)
+
+    if args.parity and not all(result.get("passed", True) for result in report["results"].values()):
+        raise SystemExit(1)
@@ -1,12 +1,17 @@
+import json
+from os import remove, replace
+from os.path import exists
 from tensorflow.keras import Model as KModel
-from tensorflow.keras.models import clone_model, load_model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.layers import Input
 from tensorflow.keras.metrics import RootMeanSquaredError, KLDivergence
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
+from chess_rules.chess_action import ChessAction
+from chess_rules.chess_backends import FunctionBackend, InferenceBackend, TFLiteBackend, agreement_report, check_parity, convert_to_tflite, make_backend, precisions
 from chess_rules.chess_pi import ChessPI
 from chess_rules.chess_state import ChessState
-from model import Model
+from evaluator import clear_nn_cache
+from model import Model, SpecMismatchError
 from pi import PI
 from state import State
 from config_loader import config
@@ -35,25 +40,40 @@ def conv_block(x, f=256, k=3, activate=True, normalize=True, kernel_init="he_uni
         x = ReLU()(x)
     return x
 
-def res_block(x):
+ModelSpec = Dict[str, int]
+spec_keys = ["blocks", "filters", "value_head_width", "policy_head_filters"]
+
+def get_spec(profile: Optional[str] = None) -> ModelSpec:
+    # the network size, profiles in the config name the sizes we switch between
+    if profile == None:
+        profile = config["model_profile"]
+
+    spec = config["model_profiles"][profile]
+    missing = [key for key in spec_keys if key not in spec]
+    if len(missing) > 0:
+        raise ValueError("model profile '{}' is missing {}".format(profile, missing))
+
+    return {key: int(spec[key]) for key in spec_keys}
+
+def res_block(x, filters: int):
     skip_x = x
-    x = conv_block(x)
-    x = conv_block(x, activate=False)
+    x = conv_block(x, filters)
+    x = conv_block(x, filters, activate=False)
     x = Add()((x, skip_x))
     x = ReLU()(x)
     return x
 
-def create_model(input_shape):
+def create_model(input_shape, spec: ModelSpec):
     input_layer = Input(shape=input_shape)
     x = input_layer
-    x = conv_block(x)
-    for _ in range(19):
-        x = res_block(x)
+    x = conv_block(x, spec["filters"])
+    for _ in range(spec["blocks"]):
+        x = res_block(x, spec["filters"])
 
     v_x = conv_block(x, 1, 1)
     v_x = Flatten()(v_x)
     v_x = Dense(
-        256, 
+        spec["value_head_width"], 
         activation="linear", 
         kernel_regularizer=l2(lambda_val), 
         # activity_regularizer=l1(lambda_val)
@@ -65,7 +85,7 @@ def create_model(input_shape):
         name="v_out"
     )(v_x)
 
-    pi_x = conv_block(x)
+    pi_x = conv_block(x, spec["policy_head_filters"])
     pi_x = conv_block(pi_x, 73, activate=False, normalize=False, kernel_init="glorot_uniform")
     pi_out = Softmax(name="pi_out")(pi_x)
 
@@ -73,6 +93,43 @@ def create_model(input_shape):
     model.summary(print_fn=logger.debug)
     return model
 
+def make_dataset(data: Model.DataType, batch_size: int, augment: bool = False) -> tf.data.Dataset:
+    # the generator is called again for every epoch so each epoch gets a new shuffle,
+    # prefetch runs it on a background thread while the previous batch trains
+    x_shape = (None,) + ChessState.get_shape()
+    pi_shape = (None,) + ChessAction.get_shape()
+
+    dataset = tf.data.Dataset.from_generator(
+        lambda: data.batches(batch_size, augment=augment),
+        output_signature=(
+            tf.TensorSpec(shape=x_shape, dtype=tf.float32),
+            (
+                tf.TensorSpec(shape=pi_shape, dtype=tf.float32),
+                tf.TensorSpec(shape=(None, 1), dtype=tf.float32)
+            )
+        )
+    )
+
+    batches = (len(data) + batch_size - 1) // batch_size
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(batches))
+    return dataset.prefetch(config["model_prefetch_batches"])
+
+def get_artifact_path(full_file_path: str, precision: str) -> str:
+    return "{}.{}.tflite".format(full_file_path, precision)
+
+def get_archive_path(full_file_path: str, spec: ModelSpec) -> str:
+    # 6x64x64x64 for the small profile
+    return "{}.{}".format(full_file_path, "x".join(str(spec[key]) for key in spec_keys))
+
+# everything save and export_inference write for one network
+saved_file_suffixes = [".weights.h5", ".spec.json"] + [suffix.format(precision) for precision in precisions for suffix in [".{}.tflite", ".{}.tflite.json"]]
+
+def opening_positions() -> np.ndarray:
+    # nn reps of the root position and everything one move away, for checks that need
+    # positions before any have been played
+    root = ChessState.from_root_state()
+    return ChessState.get_nn_reps([root] + [root.take_action(action) for action in root.get_legal_actions()])
+
 def get_pi_loss(): 
     def loss(pi_true: tf.Tensor, p_pred: tf.Tensor):
         p_loss = tf.losses.poisson(pi_true, p_pred)
@@ -84,8 +141,15 @@ def get_v_loss():
     return "mse"
 
 class ChessModel(Model):
-    def __init__(self):
-        self._model = create_model(ChessState.get_shape())
+    def __init__(self, spec: Optional[ModelSpec] = None):
+        self._spec: ModelSpec = get_spec() if spec == None else spec
+        self._model = create_model(ChessState.get_shape(), self._spec)
+        self._compile()
+
+        self._backend_name: str = config["inference_backend"]
+        self._backend: Optional[InferenceBackend] = None
+
+    def _compile(self):
         self._model.compile(
             optimizer=Adam(
                 learning_rate = config["model_learning_rate"]
@@ -102,39 +166,198 @@ class ChessModel(Model):
             }
         )
 
+    @property
+    def spec(self) -> ModelSpec:
+        return dict(self._spec)
+
+    def set_backend(self, name: str):
+        self._backend_name = name
+        self._backend = None
+
+    def _get_backend(self) -> InferenceBackend:
+        # built on first use, dropped whenever the weights change
+        if self._backend == None:
+            backend = make_backend(self._backend_name, self._model)
+            if config["inference_parity_check"] and self._backend_name != "keras":
+                self._check_parity(backend)
+
+            logger.debug("using inference backend {}".format(backend.name))
+            self._backend = backend
+
+        return self._backend
+
+    def parity(self, backend_name: str) -> Dict[str, float]:
+        # how far a backend's outputs are from keras, see python -m chess_rules.chess_benchmark --parity
+        return self._parity_diffs(make_backend(backend_name, self._model))
+
+    def _parity_diffs(self, backend: InferenceBackend) -> Dict[str, float]:
+        diffs = check_parity(self._model, backend, opening_positions())
+        logger.debug("{} parity with keras {}".format(backend.name, diffs))
+        return diffs
+
+    def _check_parity(self, backend: InferenceBackend) -> Dict[str, float]:
+        # off by default, it runs keras predict every time the backend is rebuilt
+        diffs = self._parity_diffs(backend)
+
+        tolerance = config["inference_parity_tolerance"]
+        if diffs["pi_max_abs_diff"] > tolerance or diffs["v_max_abs_diff"] > tolerance:
+            raise RuntimeError("{} outputs differ from keras by more than {}: {}".format(backend.name, tolerance, diffs))
+
+        return diffs
+
     def predict_pi_v(self, state: State) -> Tuple[PI, float]:
-        state_nn = np.array([state.get_nn_rep()])
-        pis, vs = self._model.predict(state_nn)
-        return ChessPI.from_pi_dist(pis[0]), float(vs[0])
+        state_nn = ChessState.get_nn_reps([state])
+        pis, vs = self._get_backend().predict(state_nn)
+        return ChessPI.from_pi_dist(pis[0]), float(vs[0][0])
+
+    def predict_pi_v_batch(self, states: List[State]) -> List[Tuple[PI, float]]:
+        states_nn = ChessState.get_nn_reps(states)
+        pis, vs = self._get_backend().predict(states_nn)
+        return [(ChessPI.from_pi_dist(pi), float(v[0])) for pi, v in zip(pis, vs)]
 
     @property
     def name(self) -> str:
         return "chess_model"
 
+    # saved as <full path>.spec.json with the network size and <full path>.weights.h5, the
+    # model is rebuilt from the spec on load so the custom loss never has to be deserialized
+    # a network of another size already saved under the name is moved aside to
+    # <full path>.<spec tag>.*, and load falls back to that when the spec does not match, so
+    # switching profiles back and forth keeps both networks
     def save(self, file_path: str, name: str):
         full_file_path = self.get_full_filepath(file_path, name)
-        self._model.save(full_file_path)
+        self._archive_other_spec(full_file_path)
+        self._model.save_weights(full_file_path + ".weights.h5")
+
+        with open(full_file_path + ".spec.json", "w") as file:
+            json.dump(self._spec, file)
+
+    def _archive_other_spec(self, full_file_path: str):
+        if not exists(full_file_path + ".spec.json"):
+            return
+
+        with open(full_file_path + ".spec.json") as file:
+            saved_spec: ModelSpec = json.load(file)
+
+        if saved_spec == self._spec:
+            return
+
+        archive = get_archive_path(full_file_path, saved_spec)
+        for suffix in saved_file_suffixes:
+            if exists(full_file_path + suffix):
+                replace(full_file_path + suffix, archive + suffix)
+
+        logger.info("moved {} saved with spec {} to {}".format(full_file_path, saved_spec, archive))
 
     def load(self, file_path: str, name: str):
         full_file_path = self.get_full_filepath(file_path, name)
-        self._model = load_model(full_file_path)
+
+        with open(full_file_path + ".spec.json") as file:
+            saved_spec: ModelSpec = json.load(file)
+
+        if saved_spec != self._spec:
+            archive = get_archive_path(full_file_path, self._spec)
+            if not exists(archive + ".spec.json"):
+                raise SpecMismatchError("{} was saved with spec {} but the model was built with {}".format(full_file_path, saved_spec, self._spec))
+
+            logger.info("{} holds spec {}, loading the network moved aside to {}".format(full_file_path, saved_spec, archive))
+            full_file_path = archive
+            saved_spec = self._spec
+
+        try:
+            self._model.load_weights(full_file_path + ".weights.h5")
+        except ValueError as e:
+            raise ValueError("weights in {} do not fit spec {}: {}".format(full_file_path, saved_spec, e)) from e
+
+        self._backend = None
+
+        # a reduced precision artifact written by export_inference is used for inference
+        # until the weights change again
+        precision = config["inference_precision"]
+        artifact = get_artifact_path(full_file_path, precision)
+        if precision != "float32" and exists(artifact):
+            with open(artifact, "rb") as file:
+                backend = TFLiteBackend(self._model, file.read())
+
+            try:
+                backend.predict(opening_positions()[:1])
+            except RuntimeError as e:
+                logger.error("could not run the {} inference artifact {}, inference stays float32: {}".format(precision, artifact, e))
+                return
+
+            self._backend = backend
+            logger.info("loaded {} inference artifact {}".format(precision, artifact))
+
+    def _sample_positions(self, data: Model.DataType, samples: int) -> np.ndarray:
+        if len(data) == 0: # nothing played yet
+            return opening_positions()
+
+        X, _ = data.sample(min(samples, len(data)))
+        return X
+
+    @staticmethod
+    def limit_threads(threads: int):
+        # only takes effect before tensorflow runs its first op, tflite backends follow it
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    def export_inference(self, file_path: str, name: str, calibration_data: Model.DataType, eval_data: Model.DataType):
+        precision = config["inference_precision"]
+        if precision == "float32":
+            return
+
+        artifact = get_artifact_path(self.get_full_filepath(file_path, name), precision)
+        calibration = self._sample_positions(calibration_data, config["quantization_calibration_samples"])
+
+        try:
+            flatbuffer = convert_to_tflite(self._model, precision, calibration)
+            backend = TFLiteBackend(self._model, flatbuffer)
+            # run once before anything is written, an artifact the interpreter can not prepare
+            # would otherwise fail on the first predict of everything that loads it
+            backend.predict(calibration)
+        except Exception as e:
+            # the artifact only speeds up inference, the weights are saved either way
+            logger.error("could not build the {} inference artifact, inference stays float32: {}".format(precision, e))
+            for stale in [artifact, artifact + ".json"]:
+                if exists(stale):
+                    remove(stale)
+            return
+
+        with open(artifact, "wb") as file:
+            file.write(flatbuffer)
+
+        report = agreement_report(
+            FunctionBackend(self._model), 
+            backend, 
+            self._sample_positions(eval_data, config["quantization_report_samples"])
+        )
+        logger.info("{} inference agreement with float32 {}".format(precision, report))
+
+        with open(artifact + ".json", "w") as file:
+            json.dump(report, file)
+
+        # from here on this process runs the artifact too, same as a load would, until the
+        # weights change, cached outputs of the float32 forward pass are dropped with it
+        self._backend = backend
+        clear_nn_cache()
 
     def clone(self) -> Model:
-        new_model = ChessModel()
-        new_model._model = clone_model(self._model)
+        # a freshly compiled copy so the clone can be trained if it is rolled back to
+        new_model = ChessModel(self._spec)
+        new_model._model.set_weights(self._model.get_weights())
+        new_model.set_backend(self._backend_name)
         return new_model
 
     def train(self, train_data: Model.DataType, test_data: Model.DataType):
         verbosity = config["model_verbosity"]
         epochs = config["model_epochs"]
         batch_size = config["model_batch_size"]
-        X_train, Y_train = self.data_to_np(train_data)
-        X_test, Y_test = self.data_to_np(test_data)
+        logger.debug("training on {} samples, validating on {}".format(len(train_data), len(test_data)))
         self._model.fit(
-            x=X_train,
-            y=Y_train,
-            validation_data=(X_test, Y_test),
+            make_dataset(train_data, batch_size, config["model_augment"]),
+            validation_data=make_dataset(test_data, batch_size) if len(test_data) > 0 else None,
             epochs=epochs,
-            batch_size=batch_size,
+            shuffle=False, # the buffer already shuffles every epoch
             verbose=verbosity
-        )
\ No newline at end of file
+        )
+        self._backend = None
@@ -1,4 +1,4 @@
-from pi import PI
+from pi import PI, SparsePI
 import numpy as np
 from chess_rules.chess_action import ChessAction
 
@@ -11,10 +11,29 @@ class ChessPI(PI):
     def from_pi_dist(pi_dist: np.ndarray) -> PI:
         return ChessPI(pi_dist) 
 
+    @staticmethod
+    def from_sparse_dist(indices: np.ndarray, probs: np.ndarray) -> PI:
+        return ChessSparsePI(indices, probs)
+
     @property
     def shape(self) -> tuple:
         return ChessAction.get_shape()
 
     @property
     def np_arr(self) -> np.ndarray:
-        return self._dist
\ No newline at end of file
+        return self._dist
+
+class ChessSparsePI(SparsePI):
+    @staticmethod
+    def from_pi_dist(pi_dist: np.ndarray) -> PI:
+        flat_pi = pi_dist.ravel()
+        indices = np.flatnonzero(flat_pi)
+        return ChessSparsePI(indices, flat_pi[indices])
+
+    @staticmethod
+    def from_sparse_dist(indices: np.ndarray, probs: np.ndarray) -> PI:
+        return ChessSparsePI(indices, probs)
+
+    @property
+    def shape(self) -> tuple:
+        return ChessAction.get_shape()
\ No newline at end of file
@@ -1,68 +1,127 @@
-from collections import deque
 from state import State
 from action import Action
-from chess_rules.chess_action import ChessAction
-from typing import Dict, Optional, Set
+from chess_rules.chess_action import ChessAction, mirror_index, move_to_index, promotion_slots
+from chess_rules.chess_zobrist import update_hash, zobrist_hash
+from typing import List, Optional, Set, Tuple
 import numpy as np
-from chess import BLACK, PAWN, PIECE_TYPES, QUEEN, WHITE, Board, Move
-from utils import left_shift, bool_to_nn_int
-from threading import Lock
-
-class HashableBoard(Board):
-    def __hash__(self):
-        b_boards = (self.occupied, self.pawns, self.bishops, self.kings, self.queens, self.rooks, self.knights, self.fullmove_number, self.halfmove_clock)
-        return sum(left_shift(
-            b_boards,
-            list(range((len(b_boards)-1) * 64, -1, -64))
-        ))
+from chess import BB_SQUARES, QUEEN, Board, Move, square_rank
+from config_loader import config
+from metrics import metrics
+from transposition_table import TranspositionTable
+
+# a board packed into compact_size bytes, this is what the replay buffer stores
+#   0-95    the 12 piece bitboards big endian, side to move pawn..king then the opponent
+#   96      side to move
+#   97      castling rights, bit 0/1 side to move queen/king side, bit 2/3 the opponent
+#   98-99   fullmove number big endian
+#   100     halfmove clock
+#   101-103 padding
+compact_size = 104
+
+def compact_boards(boards: List[Board]) -> np.ndarray:
+    n = len(boards)
+    masks = []
+    meta = np.zeros((n, compact_size - 96), dtype=np.uint8)
+
+    for i, board in enumerate(boards):
+        current_color = board.turn
+        opp_color = not current_color
 
-def bit_board_to_arr(bitboard: int, color: bool) -> np.ndarray:
-    out = np.zeros((8,8))
+        for color in [current_color, opp_color]:
+            occupied = board.occupied_co[color]
+            masks.extend((
+                board.pawns & occupied, 
+                board.knights & occupied, 
+                board.bishops & occupied, 
+                board.rooks & occupied, 
+                board.queens & occupied, 
+                board.kings & occupied
+            ))
+
+        castling = (
+            board.has_queenside_castling_rights(current_color)
+            | board.has_kingside_castling_rights(current_color) << 1
+            | board.has_queenside_castling_rights(opp_color) << 2
+            | board.has_kingside_castling_rights(opp_color) << 3
+        )
+        meta[i, :5] = (current_color, castling, board.fullmove_number >> 8, board.fullmove_number & 255, board.halfmove_clock)
+
+    out = np.empty((n, compact_size), dtype=np.uint8)
+    out[:, :96] = np.array(masks, dtype=">u8").view(np.uint8).reshape(n, 96)
+    out[:, 96:] = meta
+    return out
 
-    out = np.array([int(i) for i in list('{:064b}'.format(bitboard))]).reshape(8,8)
+def decode_compact(compact: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    n = len(compact)
+    if out is None:
+        out = np.empty((n,) + ChessState.get_shape(), dtype=np.float32)
 
+    # the most significant byte becomes row 0 so the layout is the same as reading
+    # '{:064b}'.format(bitboard) into an 8x8 grid
     # its flipped lr (x) but idt that matters
-
-    if color == BLACK: # flip y
-        out = np.flipud(out)
-
+    planes = np.unpackbits(compact[:, :96].reshape(n, 12, 8, 1), axis=-1)
+
+    # black pieces are flipped in y, those are the first 6 planes when black is to move
+    turns = compact[:, 96].astype(bool)
+    black = ~turns
+    planes[black, :6] = planes[black, :6, ::-1]
+    planes[turns, 6:] = planes[turns, 6:, ::-1]
+
+    castling = compact[:, 97:98] >> np.arange(4, dtype=np.uint8) & 1
+    fullmove = compact[:, 98].astype(np.float32) * 256 + compact[:, 99]
+
+    scalars = np.empty((n, 7), dtype=np.float32)
+    scalars[:, 0] = turns * 2.0 - 1
+    scalars[:, 1] = fullmove / 20
+    scalars[:, 2:6] = castling * 2.0 - 1
+    scalars[:, 6] = compact[:, 100] / 10
+
+    # planes are (piece, y, x) and the nn wants (x, y, piece)
+    out[..., :12] = planes.transpose(0, 3, 2, 1)
+    out[..., 12:] = scalars[:, None, None, :]
     return out
 
-
-state_map: Dict[HashableBoard, 'ChessState'] = {}
-max_states = 10000 # about 6.4 gb
-state_stores = deque([], maxlen=max_states)
+def encode_boards(boards: List[Board], out: Optional[np.ndarray] = None) -> np.ndarray:
+    return decode_compact(compact_boards(boards), out)
 
 
-cache_lock = Lock()
+state_size_estimate = 16 * 1024 # bytes, mostly the board and its move stack around move 40
+state_table = TranspositionTable(config["state_cache_mb"] * 1024 * 1024 // state_size_estimate)
+metrics.register_collector("state_table", state_table.stats)
 
 
 class ChessState(State):
-    def __init__(self, board: HashableBoard):
-        self._board: HashableBoard = board
+    # everything derived from the board is computed the first time it is asked for,
+    # most states created by the search are never expanded
+    __slots__ = ("_board", "_key", "_legal_action_indices", "_legal_actions", "_legal_actions_vector", "_terminal", "_outcome")
+
+    def __init__(self, board: Board, key: int):
+        self._board: Board = board
+        self._key: int = key
+        self._legal_action_indices: Optional[np.ndarray] = None
         self._legal_actions: Optional[Set[Action]] = None
-        self.get_legal_actions()
-        self._legal_actions_vector_set: bool = False
         self._legal_actions_vector: Optional[np.ndarray] = None
-        self.legal_action_vector()
-        self._nn_rep_set: bool = False
-        self._nn_rep: Optional[np.ndarray] = None
-        self.get_nn_rep()
+        self._terminal: Optional[bool] = None
+        self._outcome: Optional[int] = None
 
     @staticmethod
-    def create_state(board: HashableBoard = HashableBoard()) -> 'ChessState':
-        if board in state_map:
-            return state_map[board]
-
-        cache_lock.aquire()
-        if len(state_stores) + 1 >= max_states:
-            b = state_stores.popleft()
-            del state_map[b]
-        cache_lock.release()
-
-        new_chess_state = ChessState(board)
-        state_map[board] = new_chess_state
-        state_stores.append(board)
+    def create_state(board: Optional[Board] = None, key: Optional[int] = None) -> 'ChessState':
+        # key is the zobrist hash of board, take_action passes it in already updated
+        if board == None:
+            board = Board()
+
+        if key == None:
+            key = zobrist_hash(board)
+
+        state = state_table.get(key)
+        if state != None:
+            return state
+
+        if metrics.enabled:
+            metrics.incr("state_creations")
+
+        new_chess_state = ChessState(board, key)
+        state_table.put(key, new_chess_state)
         return new_chess_state
 
     @staticmethod
@@ -73,30 +132,53 @@ class ChessState(State):
     def board(self) -> Board:
         return self._board
 
+    def _check_outcome(self):
+        outcome = self.board.outcome()
+        self._terminal = outcome != None
+        if not self._terminal:
+            return
+
+        result = outcome.result()
+        if result == "1/2-1/2":
+            self._outcome = 0
+        else:
+            self._outcome = 1 if result == "1-0" else -1 # check if this is correct
+
     @property
     def terminal(self) -> bool:
-        return self.board.is_game_over()
+        if self._terminal == None:
+            self._check_outcome()
+        return self._terminal
 
     @property
     def outcome(self) -> int:
-        result = self.board.outcome().result()
-        if result == "1/2-1/2":
-            return 0
-
-        return 1 if result == "1-0" else -1 # check if this is correct
+        if self._terminal == None:
+            self._check_outcome()
+        return self._outcome
 
     def legal_action_vector(self) -> np.ndarray:
-        if self._legal_actions_vector_set:
+        if self._legal_actions_vector is not None:
             return self._legal_actions_vector
 
         self._legal_actions_vector = np.zeros(ChessAction.get_shape(), dtype=np.float16)
-        legal_actions = self.get_legal_actions()
-        for action in legal_actions:
-            self._legal_actions_vector[action.action_tuple] = 1
-
-        self._legal_actions_vector_set = True
+        self._legal_actions_vector.flat[self.legal_action_indices()] = 1
         return self._legal_actions_vector
 
+    def legal_action_indices(self) -> np.ndarray:
+        # in board.legal_moves order, straight from the move table without creating actions
+        if self._legal_action_indices is not None:
+            return self._legal_action_indices
+
+        from_squares = []
+        to_squares = []
+        promotions = []
+        for move in self.board.legal_moves:
+            from_squares.append(move.from_square)
+            to_squares.append(move.to_square)
+            promotions.append(promotion_slots[move.promotion or 0])
+
+        self._legal_action_indices = move_to_index[int(self.board.turn), from_squares, to_squares, promotions].astype(np.int32)
+        return self._legal_action_indices
 
     @staticmethod
     def get_shape() -> tuple:
@@ -106,26 +188,20 @@ class ChessState(State):
         if self._legal_actions != None:
             return self._legal_actions
 
-        self._legal_actions = set()
-
-        for move in self.board.legal_moves:
-            self._legal_actions.add(ChessAction.from_move(move, self.board.turn))
-
+        self._legal_actions = set(ChessAction.from_flat_index(index) for index in self.legal_action_indices().tolist())
         return self._legal_actions
 
     def take_action(self, action: ChessAction) -> State:
         new_board: Board = self.board.copy() # if stack=False it wont check for threefold repetition, but expensive if true
         move = action.to_move(new_board.turn)
 
-        # autopromote to queen if possible
-        if new_board.piece_at(move.from_square) == PAWN and (
-            (new_board.color_at(move.from_square) == WHITE and move.to_square // 8 == 0) 
-         or (new_board.color_at(move.from_square) == BLACK and move.to_square // 8 == 7)):
+        # queen promotions are encoded as plain queen moves so the promotion is added back here
+        if move.promotion == None and new_board.pawns & BB_SQUARES[move.from_square] and square_rank(move.to_square) in (0, 7):
             move = Move(move.from_square, move.to_square, promotion=QUEEN)
         
         new_board.push(move)
 
-        new_state = ChessState.create_state(new_board)
+        new_state = ChessState.create_state(new_board, update_hash(self._key, self.board, new_board))
         new_state._board = new_board
         # new_state.board.move_stack = new_board.move_stack # because we save the old states we must copy the move stack
         return new_state
@@ -140,46 +216,44 @@ class ChessState(State):
         if type(other) != ChessState:
             return False
 
-        if hash(self) != hash(other):
-            return False
-
         other: ChessState = other
-        return self.board == other._board
+        return self._key == other._key
 
     def __hash__(self) -> int:
-       return hash(self.board)
+       return self._key
 
     def get_nn_rep(self) -> np.ndarray:
-        if self._nn_rep_set:
-           return self._nn_rep
+        # not cached, it is only needed when the state goes to the nn
+        return encode_boards([self.board])[0]
 
-        self._nn_rep = np.zeros(tuple(reversed(ChessState.get_shape())))
+    @staticmethod
+    def get_nn_reps(states: List['ChessState'], out: Optional[np.ndarray] = None) -> np.ndarray:
+        return encode_boards([state.board for state in states], out)
 
-        i = 0
+    @staticmethod
+    def compact_rep_size() -> int:
+        return compact_size
 
-        current_color = self.board.turn
-        opp_color = not current_color
+    @staticmethod
+    def get_compact_reps(states: List['ChessState']) -> np.ndarray:
+        return compact_boards([state.board for state in states])
 
-        for color in [current_color, opp_color]:
-            for piece_type in PIECE_TYPES:
-                self._nn_rep[i] = bit_board_to_arr(self.board.pieces_mask(piece_type, color), color)
-                i += 1
-
-        self._nn_rep[i] = bool_to_nn_int(current_color)
-        i += 1
-        self._nn_rep[i] = (self.board.fullmove_number / 20)
-        i += 1
-        self._nn_rep[i] = bool_to_nn_int(self.board.has_queenside_castling_rights(current_color))
-        i += 1
-        self._nn_rep[i] = bool_to_nn_int(self.board.has_kingside_castling_rights(current_color))
-        i += 1
-        self._nn_rep[i] = bool_to_nn_int(self.board.has_queenside_castling_rights(opp_color))
-        i += 1
-        self._nn_rep[i] = bool_to_nn_int(self.board.has_kingside_castling_rights(opp_color))
-        i += 1
-        self._nn_rep[i] = (self.board.halfmove_clock / 10)
-
-        self._nn_rep = np.transpose(self._nn_rep, (2, 1, 0))
-
-        self._nn_rep_set = True
-        return self._nn_rep
+    @staticmethod
+    def nn_reps_from_compact(compact: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        return decode_compact(compact, out)
+
+    @staticmethod
+    def augment(nn_reps: np.ndarray, pis: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # mirroring left to right is only a symmetry once nobody can castle, en passant is
+        # not part of the nn rep so it needs no care, half of those samples get mirrored
+        no_castling = np.all(nn_reps[:, 0, 0, 14:18] < 0, axis=1)
+        mirror = no_castling & (np.random.random(len(nn_reps)) < 0.5)
+        if not np.any(mirror):
+            return nn_reps, pis
+
+        # axis 1 of the nn rep is the file
+        nn_reps[mirror] = nn_reps[mirror][:, ::-1]
+
+        flat_pis = pis.reshape(len(pis), -1)
+        flat_pis[mirror] = flat_pis[mirror][:, mirror_index]
+        return nn_reps, pis
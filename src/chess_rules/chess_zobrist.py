@@ -0,0 +1,70 @@
+from typing import List
+import numpy as np
+from chess import A1, A8, BLACK, H1, H8, WHITE, Board, square_file
+
+MASK_64 = (1 << 64) - 1
+
+_keys = np.random.default_rng(0x5EED).integers(0, MASK_64, size=12 * 64 + 4 + 8 + 1, dtype=np.uint64, endpoint=True).tolist()
+
+# planes are white pawn..king then black pawn..king, same order as _piece_masks
+PIECE_KEYS: List[List[int]] = [_keys[i * 64:(i + 1) * 64] for i in range(12)]
+CASTLING_KEYS = list(zip((A1, H1, A8, H8), _keys[12 * 64:12 * 64 + 4]))
+EP_KEYS: List[int] = _keys[12 * 64 + 4:12 * 64 + 12]
+SIDE_KEY: int = _keys[-1]
+
+def _mix(x: int) -> int:
+    # splitmix64 finalizer
+    x = (x + 0x9E3779B97F4A7C15) & MASK_64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return x ^ (x >> 31)
+
+def _piece_masks(board: Board) -> List[int]:
+    out = []
+    for color in [WHITE, BLACK]:
+        occupied = board.occupied_co[color]
+        out.extend((
+            board.pawns & occupied,
+            board.knights & occupied,
+            board.bishops & occupied,
+            board.rooks & occupied,
+            board.queens & occupied,
+            board.kings & occupied
+        ))
+    return out
+
+def _xor_squares(key: int, keys: List[int], mask: int) -> int:
+    while mask:
+        square = (mask & -mask).bit_length() - 1
+        key ^= keys[square]
+        mask &= mask - 1
+    return key
+
+def _state_key(board: Board) -> int:
+    # everything besides the pieces, the clocks are part of the key because they are part of the nn input
+    key = 0
+    for square, square_key in CASTLING_KEYS:
+        if board.castling_rights & (1 << square):
+            key ^= square_key
+
+    if board.ep_square != None:
+        key ^= EP_KEYS[square_file(board.ep_square)]
+
+    if board.turn == BLACK:
+        key ^= SIDE_KEY
+
+    return key ^ _mix((board.fullmove_number << 16) | board.halfmove_clock)
+
+def zobrist_hash(board: Board) -> int:
+    key = _state_key(board)
+    for keys, mask in zip(PIECE_KEYS, _piece_masks(board)):
+        key = _xor_squares(key, keys, mask)
+    return key
+
+def update_hash(key: int, board: Board, new_board: Board) -> int:
+    # new_board is board after one move, only the squares that changed are xored so
+    # captures, castling, en passant and promotions need no special cases
+    for keys, before, after in zip(PIECE_KEYS, _piece_masks(board), _piece_masks(new_board)):
+        key = _xor_squares(key, keys, before ^ after)
+
+    return key ^ _state_key(board) ^ _state_key(new_board)
@@ -1,11 +1,12 @@
-from collections import deque
 import json
 from os.path import exists, isdir, join
 from os import makedirs
-from typing import Dict, Optional, Type
+from typing import Dict, List, Optional, Tuple, Type
 import numpy as np
+from evaluator import clear_nn_cache
 from game import Game
-from model import Model
+from model import Model, SpecMismatchError
+from replay_buffer import ReplayBuffer
 from state import State
 from pi import PI
 from config_loader import config
@@ -14,32 +15,31 @@ from logger import get_logger
 logger = get_logger(__name__)
 
 json_file_name = "params.json"
+train_data_dir = "train_data"
+test_data_dir = "test_data"
 
-DataSet = Dict[str, deque]
+DataSet = ReplayBuffer
 
-def make_empty_ds(max_len: int):
-    ds = {
-        "states": deque([], maxlen=max_len),
-        "pis": deque([], maxlen=max_len),
-        "vs": deque([], maxlen=max_len)
-    }
-    return ds
+def make_empty_ds(max_len: int, game: Type[Game]) -> DataSet:
+    return ReplayBuffer(max_len, game.get_state_class(), game.get_action_class().get_shape())
 
 class ComponentManager:
     def __init__(self, game: Type[Game], file_path: str, load: bool = False):
         self._nns: Dict[str, Model] = {}
+        self._game = game
 
         max_len = config["max_data_points"]
         self._train_split_percent = config["train_percent"]
         self._train_max_len = int(max_len * self._train_split_percent)
         self._test_max_len = max_len - self._train_max_len
-        self._train_data: DataSet = make_empty_ds(self._train_max_len)
-        self._test_data: DataSet = make_empty_ds(self._test_max_len)
+        self._train_data: DataSet = make_empty_ds(self._train_max_len, game)
+        self._test_data: DataSet = make_empty_ds(self._test_max_len, game)
 
         self._best_nn: Optional[str] = None
+        # evaluator version of each model when it was last written to or read from disk
+        self._saved_versions: Dict[str, int] = {}
         self._file_path: str = file_path
         self._iterations = 0
-        self._game = game
 
         if load and exists(file_path):
             self.load()
@@ -48,6 +48,10 @@ class ComponentManager:
     def game(self) -> Type[Game]:
         return self._game
 
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
     def save(self):
         fp = self._file_path
         if exists(fp) and not isdir(fp):
@@ -67,8 +71,20 @@ class ComponentManager:
         # save nns
         for name in self._nns:
             self._nns[name].save(fp, name)
+            self._saved_versions[name] = self._nns[name].version
 
-        
+        # after the first save the buffers are reopened from disk, from then on they are
+        # memory mapped and saving only has to flush them
+        for train, dir_name in [(True, train_data_dir), (False, test_data_dir)]:
+            self.get_ds(train).save(join(fp, dir_name))
+            self._set_ds(train, self._open_ds(join(fp, dir_name)))
+
+        # last, so the checkpoint above is complete whatever the export does
+        for name in self._nns:
+            self._nns[name].export_inference(fp, name, self._train_data, self._test_data)
+
+    def _open_ds(self, file_path: str) -> DataSet:
+        return ReplayBuffer.from_file(file_path, self.game.get_state_class(), self.game.get_action_class().get_shape())
 
     def load(self):
         fp = self._file_path
@@ -86,20 +102,45 @@ class ComponentManager:
         self._iterations = params["iterations"]
 
         self._nns = {}
+        self._saved_versions = {}
 
         for name in nn_names:
-            self._nns[name] = self.game.get_model_class().from_file(fp, name)
-
-        # load data set
+            try:
+                self._nns[name] = self.game.get_model_class().from_file(fp, name)
+                self._saved_versions[name] = self._nns[name].version
+            except SpecMismatchError as e:
+                # the configured network size changed and no network of that size was saved
+                # before, it starts from scratch and catches up by training on the saved
+                # replay buffer, the old one is moved aside on the next save
+                logger.warning("{}, starting {} over with the configured size".format(e, name))
+                self._nns[name] = self.game.get_model_class()()
+
+        for train, dir_name in [(True, train_data_dir), (False, test_data_dir)]:
+            if exists(join(fp, dir_name)):
+                data_set = self._open_ds(join(fp, dir_name))
+                if data_set.capacity != self.get_max_len(train):
+                    logger.warning("saved data set holds {} samples, config asks for {}, keeping the saved size".format(data_set.capacity, self.get_max_len(train)))
+                self._set_ds(train, data_set)
 
     def get_best_nn(self) -> Model:
         return self._nns[self._best_nn]
 
     def add_model(self, name: str, model: Model, best: bool = True):
+        if name in self._nns:
+            # the old weights will not be asked for again
+            clear_nn_cache()
+
         self._nns[name] = model
         if best:
             self._best_nn = name
 
+    def rollback_model(self, name: str, prev_model: Model):
+        # the model under name lost to the one it was trained from, so that one goes back
+        # in its place and this iteration's training is dropped
+        logger.info("rolling back {}".format(name))
+        self._nns[name] = prev_model
+        clear_nn_cache()
+
     def del_model(self, name: str):
         del self._nns[name]
 
@@ -108,32 +149,41 @@ class ComponentManager:
         self.del_model(name)
         return result
 
+    def has_model(self, name: str) -> bool:
+        return name in self._nns
+
     def get_model(self, name: str) -> Model:
         return self._nns[name]
 
+    def is_saved(self, name: str) -> bool:
+        # whether the weights on disk are the ones the model holds now
+        return self._saved_versions.get(name) == self._nns[name].version
+
     def increment_iter(self):
         self._iterations += 1
 
-    def pop_left_dp(self, train: bool):
-        data_set = self.get_data_set(train)
-
-        data_set["states"].popleft()
-        data_set["pis"].popleft()
-        data_set["vs"].popleft()
-        
-
     def add_data_point(self, state: State, pi: PI, v: float):
-        train = bool(np.random.choice([1,0], p=[self._train_split_percent, 1-self._train_split_percent]))
+        self.add_data_points([state], [pi], [v])
 
-        data_set = self.get_ds(train)
+    def add_data_points(self, states: List[State], pis: List[PI], vs: List[float]):
+        # one vectorized draw decides the split for the whole batch
+        train = np.random.random(len(states)) < self._train_split_percent
 
-        if 1 + self.ds_length(train) > self.get_max_len(train):
-            logger.debug("removing 1 datapoint")
-            self.pop_left_dp(train)
+        for data_set, mask in [(self._train_data, train), (self._test_data, ~train)]:
+            selected = np.flatnonzero(mask)
+            data_set.add(
+                [states[i] for i in selected], 
+                [pis[i] for i in selected], 
+                [vs[i] for i in selected]
+            )
 
-        data_set["states"].append(state)
-        data_set["pis"].append(pi)
-        data_set["vs"].append(v)
+    def add_compact_data_points(self, compact: np.ndarray, sparse_pis: List[Tuple[np.ndarray, np.ndarray]], vs: np.ndarray):
+        # same as add_data_points for samples that are already packed, see ReplayBuffer.add_compact
+        train = np.random.random(len(compact)) < self._train_split_percent
+
+        for data_set, mask in [(self._train_data, train), (self._test_data, ~train)]:
+            selected = np.flatnonzero(mask)
+            data_set.add_compact(compact[selected], [sparse_pis[i] for i in selected], vs[selected])
 
     def get_max_len(self, train: bool) -> int:
         if train:
@@ -148,15 +198,18 @@ class ComponentManager:
             data_set = self._test_data
         return data_set
 
-    def ds_length(self, train: bool) -> int:
-        data_set = self.get_ds(train)
+    def _set_ds(self, train: bool, data_set: DataSet):
+        if train:
+            self._train_data = data_set
+        else:
+            self._test_data = data_set
 
-        return len(data_set["states"])
+    def ds_length(self, train: bool) -> int:
+        return len(self.get_ds(train))
 
     @property
     def iterations(self):
         return self._iterations
 
     def get_data_set(self, train: bool) -> Model.DataType:
-        data_set = self.get_ds(train)
-        return data_set["states"], (data_set["pis"], data_set["vs"])
+        return self.get_ds(train)
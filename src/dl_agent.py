@@ -2,12 +2,12 @@ from typing import Type
 from action import Action
 from agent import Agent
 from game import Game
+from evaluator import Evaluator
 from mcts import MCTS
-from model import Model
 from state import State
 
 class DLAgent(Agent):
-    def __init__(self, nn: Model, stochastic: bool, game: Type[Game]):
+    def __init__(self, nn: Evaluator, stochastic: bool, game: Type[Game]):
         self._nn = nn
         self._stochastic = stochastic
         self._mcts = MCTS(nn, game)
@@ -22,4 +22,4 @@ class DLAgent(Agent):
         return pi.get_best_action(self._game.get_action_class())
 
     def display_outcome(self, outcome: int):
-        self._mcts = MCTS(self._nn, self._game)
\ No newline at end of file
+        self._mcts.reset()
\ No newline at end of file
@@ -0,0 +1,46 @@
+from abc import ABC, abstractmethod
+from itertools import count
+from typing import List, Optional, Tuple
+from config_loader import config
+from metrics import metrics
+from state import State
+from pi import PI
+from transposition_table import TranspositionTable
+
+# every set of weights gets a version no other evaluator has had, 0 means not assigned yet
+_versions = count(1)
+
+class Evaluator(ABC):
+    _version = 0
+
+    @abstractmethod
+    def predict_pi_v(self, state: State) -> Tuple[PI, float]:
+        pass
+
+    def predict_pi_v_batch(self, states: List[State]) -> List[Tuple[PI, float]]:
+        return [self.predict_pi_v(state) for state in states]
+
+    @property
+    def version(self) -> int:
+        # part of the nn cache key, so outputs of old weights are never served
+        if self._version == 0:
+            self._version = next(_versions)
+        return self._version
+
+    def weights_changed(self):
+        self._version = next(_versions)
+
+# outputs shared by every search in the process, keyed by (state hash, evaluator version), the
+# value is (priors over state.legal_action_indices() as float16, v)
+# bytes per entry, measured with tracemalloc at about 460 for 35 legal moves (the priors array
+# is ~180 of it, the key and value tuples, ints and the ordered dict slot the rest), each
+# further legal move adds 2
+nn_cache_entry_estimate = 480
+nn_cache: Optional[TranspositionTable] = None
+if config["nn_cache_mb"] > 0:
+    nn_cache = TranspositionTable(config["nn_cache_mb"] * 1024 * 1024 // nn_cache_entry_estimate)
+    metrics.register_collector("nn_cache", nn_cache.stats)
+
+def clear_nn_cache():
+    if nn_cache != None:
+        nn_cache.clear()
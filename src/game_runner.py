@@ -1,8 +1,13 @@
-from typing import Dict, Optional, Tuple, Type
+from concurrent.futures import ThreadPoolExecutor
+from math import log
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple, Type
 from agent import Agent
 import numpy as np
+from config_loader import config
 from dl_agent import DLAgent
 from game import Game
+from inference_server import InferenceServer
 from logger import get_logger
 from model import Model
 from state import State
@@ -10,62 +15,166 @@ from state import State
 logger = get_logger(__name__)
 
 class GameRunner:
-    def __init__(self, agent1: Agent, agent2: Agent, game: Type[Game]):
+    def __init__(self, agent1: Agent, agent2: Agent, game: Type[Game], nns: Optional[Tuple[Model, Model]] = None, stochastic: bool = False):
         self._agent1 = agent1
         self._agent2 = agent2
         self._agents = [agent1, agent2]
         self._game = game
+        # only known when created from nns, needed to build fresh agents for parallel games
+        self._nns = nns
+        self._stochastic = stochastic
 
     @staticmethod
     def from_nns(nn1: Model, nn2: Model, game: Type[Game], stochastic: bool = False) -> 'GameRunner':
         dl_a1 = DLAgent(nn1, stochastic, game)
         dl_a2 = DLAgent(nn2, stochastic, game)
-        return GameRunner(dl_a1, dl_a2, game)
+        return GameRunner(dl_a1, dl_a2, game, (nn1, nn2), stochastic)
 
     # note that wins indicates wins for agent1 and losses indicate losses for agent1
-    def best_of(self, N: int, starting_agent: Optional[int] = None) -> Dict[str, int]:
-        wtl = [0, 0, 0]
+    # game_times holds the seconds each game took
+    def best_of(self, N: int, starting_agent: Optional[int] = None) -> Dict[str, Any]:
+        return GameRunner._results_to_dict(self._play_sequential(N, starting_agent))
+
+    def best_of_parallel(self, N: int, starting_agent: Optional[int] = None, games_at_once: int = config["arena_parallel_games"]) -> Dict[str, Any]:
+        return GameRunner._results_to_dict(self._play_parallel(N, starting_agent, games_at_once))
+
+    def sprt(
+        self, 
+        max_games: int = config["sprt_max_games"], 
+        p0: float = config["sprt_p0"], 
+        p1: float = config["sprt_p1"], 
+        alpha: float = config["sprt_alpha"], 
+        beta: float = config["sprt_beta"], 
+        games_at_once: int = config["arena_parallel_games"]
+    ) -> Dict[str, Any]:
+        # sequential probability ratio test on the decisive games, h0 is agent 1 winning them
+        # with probability p0 and h1 with p1 > p0, draws carry no information here
+        # games are played games_at_once at a time until the log likelihood ratio leaves
+        # (lower, upper) or max_games is reached, decision is "better", "worse" or "inconclusive"
+        # with p0 0.35, p1 0.65 and alpha = beta = 0.05 a decisive game moves the llr by 0.62
+        # and the bounds are 2.94 away, so about 5 more wins than losses decide it
+        lower = log(beta / (1 - alpha))
+        upper = log((1 - beta) / alpha)
+        win_llr = log(p1 / p0)
+        loss_llr = log((1 - p1) / (1 - p0))
+
+        results: List[Tuple[int, float]] = []
+        llr = 0.0
+
+        while len(results) < max_games and lower < llr < upper:
+            N = min(games_at_once, max_games - len(results))
+            if N > 1 and self._nns != None:
+                round_results = self._play_parallel(N, None, N)
+            else:
+                round_results = self._play_sequential(N, None)
+
+            for outcome, _ in round_results:
+                if outcome == 1:
+                    llr += win_llr
+                elif outcome == -1:
+                    llr += loss_llr
+
+            results.extend(round_results)
+            logger.debug("sprt after {} games, llr {:.3f} in ({:.3f}, {:.3f})".format(len(results), llr, lower, upper))
+
+        if llr >= upper:
+            decision = "better"
+        elif llr <= lower:
+            decision = "worse"
+        else:
+            decision = "inconclusive"
+
+        out = GameRunner._results_to_dict(results)
+        out["llr"] = llr
+        out["decision"] = decision
+        return out
+
+    def _play_sequential(self, N: int, starting_agent: Optional[int]) -> List[Tuple[int, float]]:
+        results = []
 
         for i in range(N):
             logger.debug("starting game {} of {}".format(i, N))
-            if starting_agent == None: # random starting side
-                side = np.random.randint(0, 2)
-            else:
-                side = starting_agent
+            results.append(self._timed_game(self._agents, starting_agent))
 
-            logger.debug("agent {} starting this game".format(side + 1))
+        return results
+
+    def _play_parallel(self, N: int, starting_agent: Optional[int], games_at_once: int) -> List[Tuple[int, float]]:
+        # every game gets its own pair of agents so the trees are not shared, the searches
+        # of all games running at once are batched by one inference server per nn
+        if self._nns == None:
+            raise ValueError("parallel games need the nns, create the runner with from_nns")
+
+        servers = [InferenceServer(nn) for nn in self._nns]
+        for server in servers:
+            server.start()
+
+        def play(i: int) -> Tuple[int, float]:
+            logger.debug("starting game {} of {}".format(i, N))
+            agents = [DLAgent(server, self._stochastic, self._game) for server in servers]
+            return self._timed_game(agents, starting_agent)
 
-            state: State = self._game.get_state_class().from_root_state()
+        try:
+            with ThreadPoolExecutor(games_at_once) as executor:
+                results = list(executor.map(play, range(N)))
+        finally:
+            for server in servers:
+                server.stop()
 
-            while not state.terminal:
-                agent = self._agents[side]
-                action = agent.get_move(state)
+        for i, server in enumerate(servers):
+            logger.debug("agent {} inference stats {}".format(i + 1, server.stats()))
 
-                state = state.take_action(action)
+        return results
 
-                side = (side + 1) % 2
+    def _timed_game(self, agents: List[Agent], starting_agent: Optional[int]) -> Tuple[int, float]:
+        start = perf_counter()
+        outcome = self._play_game(agents, starting_agent)
+        return outcome, perf_counter() - start
 
-            outcome = state.outcome # 1->white win 
+    def _play_game(self, agents: List[Agent], starting_agent: Optional[int]) -> int:
+        # returns 1 if agents[0] won, -1 if agents[1] won and 0 for a draw
+        if starting_agent == None: # random starting side
+            starting_agent = np.random.randint(0, 2)
 
-            self._agent1.display_outcome(outcome)
-            self._agent2.display_outcome(-outcome)
+        side = starting_agent
+        logger.debug("agent {} starting this game".format(side + 1))
 
-            logger.debug("game ended with {}".format("white winning" if outcome == 1 else "draw" if outcome == 0 else "black winning"))
+        state: State = self._game.get_state_class().from_root_state()
 
-            if starting_agent == 1:
-                outcome = -outcome
+        while not state.terminal:
+            agent = agents[side]
+            action = agent.get_move(state)
 
-            # outcome: 1->agent 1 wins, -1->agent 2 wins
+            state = state.take_action(action)
 
-            logger.debug("game ended with {}".format("agent 1 winning" if outcome == 1 else "draw" if outcome == 0 else "agent 2 winning"))
+            side = (side + 1) % 2
 
+        outcome = state.outcome # 1->white win 
 
+        agents[0].display_outcome(outcome)
+        agents[1].display_outcome(-outcome)
+
+        logger.debug("game ended with {}".format("white winning" if outcome == 1 else "draw" if outcome == 0 else "black winning"))
+
+        if starting_agent == 1:
+            outcome = -outcome
+
+        # outcome: 1->agent 1 wins, -1->agent 2 wins
+
+        logger.debug("game ended with {}".format("agent 1 winning" if outcome == 1 else "draw" if outcome == 0 else "agent 2 winning"))
+
+        return outcome
+
+    @staticmethod
+    def _results_to_dict(results: List[Tuple[int, float]]) -> Dict[str, Any]:
+        wtl = [0, 0, 0]
+        for outcome, _ in results:
             wtl[outcome] += 1
 
         return {
             "wins": wtl[1],
             "ties": wtl[0],
             "losses": wtl[-1],
+            "game_times": [game_time for _, game_time in results]
         }
 
     @staticmethod 
@@ -0,0 +1,163 @@
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from evaluator import Evaluator
+from config_loader import config
+from logger import get_logger
+from metrics import metrics
+from pi import PI
+from state import State
+
+logger = get_logger(__name__)
+
+class _Request:
+    def __init__(self, states: List[State]):
+        self.states = states
+        self.future: Future = Future()
+        self.created = perf_counter()
+
+class InferenceServer(Evaluator):
+    # single thread owning the nn, every MCTS using the server gets its leaves
+    # merged with the other callers' into one forward pass
+    def __init__(self, nn: Evaluator, max_batch_size: int = config["inference_max_batch_size"], max_wait_ms: float = config["inference_max_wait_ms"]):
+        self._nn = nn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._queue: Queue = Queue()
+        self._carry: Optional[_Request] = None
+        self._thread: Optional[Thread] = None
+        self._stats_lock = Lock()
+        self.reset_stats()
+
+    def start(self):
+        if self._thread != None:
+            raise RuntimeError("inference server already running")
+
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread == None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self) -> 'InferenceServer':
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def version(self) -> int:
+        return self._nn.version
+
+    def predict_pi_v(self, state: State) -> Tuple[PI, float]:
+        return self.predict_pi_v_batch([state])[0]
+
+    def predict_pi_v_batch(self, states: List[State]) -> List[Tuple[PI, float]]:
+        if self._thread == None:
+            raise RuntimeError("inference server must be started before predicting")
+
+        request = _Request(states)
+        self._queue.put(request)
+        return request.future.result()
+
+    def _serve(self):
+        running = True
+        while running:
+            requests, running = self._gather()
+            if len(requests) > 0:
+                self._run(requests)
+
+    def _gather(self) -> Tuple[List[_Request], bool]:
+        if self._carry != None:
+            first, self._carry = self._carry, None
+        else:
+            first = self._queue.get()
+
+        if first == None:
+            return [], False
+
+        requests = [first]
+        size = len(first.states)
+        deadline = perf_counter() + self._max_wait
+
+        while size < self._max_batch_size:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                request = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+
+            if request == None:
+                return requests, False
+
+            if size + len(request.states) > self._max_batch_size:
+                # would overflow the batch, it goes first in the next one
+                self._carry = request
+                break
+
+            requests.append(request)
+            size += len(request.states)
+
+        return requests, True
+
+    def _run(self, requests: List[_Request]):
+        states = [state for request in requests for state in request.states]
+
+        start = perf_counter()
+        try:
+            outputs = self._nn.predict_pi_v_batch(states)
+        except Exception as e:
+            logger.error("inference batch of {} failed: {}".format(len(states), e))
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        end = perf_counter()
+
+        i = 0
+        for request in requests:
+            request.future.set_result(outputs[i:i + len(request.states)])
+            i += len(request.states)
+
+        if metrics.enabled:
+            metrics.observe("server_batch_size", len(states))
+            metrics.add_time("server_forward", end - start)
+
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(requests)
+            self._samples += len(states)
+            self._forward_time += end - start
+            self._latency += sum(end - request.created for request in requests)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._batches = 0
+            self._requests = 0
+            self._samples = 0
+            self._forward_time = 0.0
+            self._latency = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            batches = max(self._batches, 1)
+            requests = max(self._requests, 1)
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "samples": self._samples,
+                "mean_batch_size": self._samples / batches,
+                "batch_fill": self._samples / (batches * self._max_batch_size),
+                "mean_forward_ms": 1000 * self._forward_time / batches,
+                "mean_latency_ms": 1000 * self._latency / requests
+            }
@@ -1,117 +1,287 @@
-from typing import Dict, Tuple, Type
+from logging import DEBUG
+from math import sqrt
+from time import perf_counter
+from typing import Dict, List, Optional, Set, Tuple, Type
 from game import Game
 from state import State
 from config_loader import config
-from model import Model
+from evaluator import Evaluator, nn_cache
 import numpy as np
 from action import Action
 from logger import get_logger
-from pi import PI
+from metrics import metrics
+from pi import PI, SparseN
 
 logger = get_logger(__name__)
 EPS = 1e-8
 
+def _search_rates() -> Dict[str, float]:
+    # search time includes the inference the search waited on
+    search = metrics.get_seconds("search")
+    return {
+        "simulations_per_sec": metrics.get_count("mcts_simulations") / search if search > 0 else 0.0,
+        "inference_fraction": metrics.get_seconds("inference") / search if search > 0 else 0.0
+    }
+
+metrics.register_collector("mcts", _search_rates)
+
+def puct_argmax(q: np.ndarray, c_priors: np.ndarray, n_edge: np.ndarray, n_node: float) -> int:
+    # u = q + c * p * sqrt(n_node) / (1 + n_edge), np.argmax returns the first maximum
+    # so ties go to the earliest legal action just like the old strict '>' loop did
+    u = sqrt(n_node + EPS) / (1 + n_edge)
+    u *= c_priors
+    u += q
+    return int(u.argmax())
+
+Path = List[Tuple[int, int]] # (node, slot) for every edge taken
+
 class MCTS:
     CONTINUE = 1000
 
 
-    def __init__(self, nn: Model, game: Type[Game]):
-        self._EV_edge: Dict[Tuple[State, Action], float] = {}
-        self._EV_node: Dict[State, float] = {}
-        self._N_edge: Dict[Tuple[State, Action], int] = {}
-        self._N_node: Dict[State, int] = {}
-        self._nn_out: Dict[State, PI] = {}
-        self._fin: Dict[State, int] = {}
-        self._valid: Dict[State, np.ndarray] = {}
-        self._nn: Model = nn
+    def __init__(self, nn: Evaluator, game: Type[Game]):
+        self._nn: Evaluator = nn
         self._game: Game = game
+        self._action_cls: Type[Action] = game.get_action_class()
+        self._c: float = config["exploration_coefficient"]
+        self._batch_size: int = config["mcts_batch_size"]
+        self._virtual_loss: int = config["virtual_loss"]
+        self.reset()
+
+    def reset(self):
+        # every state gets a node id, the edges of a node are stored in arrays indexed by
+        # the slot of the action in that node's legal action list
+        self._node_index: Dict[State, int] = {}
+        self._root: Optional[int] = None
+        self._free: List[int] = []
+        self._states: List[Optional[State]] = []
+        self._fin: List[Optional[int]] = []
+        self._N_node: List[Optional[int]] = []
+        self._action_indices: List[Optional[np.ndarray]] = []
+        self._P: List[Optional[np.ndarray]] = []
+        self._cP: List[Optional[np.ndarray]] = []
+        self._N_edge: List[Optional[np.ndarray]] = []
+        self._W_edge: List[Optional[np.ndarray]] = []
+        self._Q_edge: List[Optional[np.ndarray]] = []
+        self._children: List[Optional[np.ndarray]] = []
+        self._node_stores = [
+            self._states, self._fin, self._N_node, self._action_indices, 
+            self._P, self._cP, self._N_edge, self._W_edge, self._Q_edge, self._children
+        ]
+
+    def __len__(self) -> int:
+        return len(self._states) - len(self._free)
 
     def get_pi(self, state: State, tau: float, suppress_warning: bool = False) -> PI:
-        for _ in range(config["simulations"]):
-            self.update(state, suppress_warning=suppress_warning)
-
-        return self._game.get_PI_class().from_N_temp(self._get_N_mat(state), tau)
-
-    def _get_N_mat(self, state: State) -> np.ndarray:
-        action_cls = self._game.get_action_class()
-        shape = action_cls.get_shape()
-        out = np.zeros(shape)
-
-        for i in range(shape[0]):
-            for j in range(shape[1]):
-                for k in range(shape[2]):
-                    action = action_cls.from_action_tuple((i,j,k))
-                    if (state, action) not in self._N_edge:
-                        out[i][j][k] = 0
-                    else:
-                        out[i][j][k] = self._N_edge[(state,action)]
-        return out
+        if self._root == None or self._states[self._root] != state:
+            self.reroot(state)
+
+        root = self._root
+        start = perf_counter() if metrics.enabled else 0
+
+        simulations = config["simulations"]
+        while simulations > 0:
+            simulations -= self._run_batch(root, min(self._batch_size, simulations), suppress_warning)
+
+        if metrics.enabled:
+            metrics.add_time("search", perf_counter() - start)
+            metrics.incr("mcts_simulations", config["simulations"])
+
+        return self._game.get_PI_class().from_N_temp(self._get_sparse_N(root), tau)
+
+    def reroot(self, state: State):
+        # the subtree under state becomes the tree, its visit counts are kept and every
+        # node that can no longer be reached is freed so a long game does not keep growing
+        root = self._node_index.get(state)
+        if root == None:
+            self.reset()
+            self._root = self._get_node(state)
+            return
+
+        reachable = {root}
+        stack = [root]
+        while len(stack) > 0:
+            children = self._children[stack.pop()]
+            if children is None:
+                continue
+
+            for child in children[children >= 0].tolist():
+                if child not in reachable:
+                    reachable.add(child)
+                    stack.append(child)
+
+        size = len(self)
+        for node, node_state in enumerate(self._states):
+            if node_state is not None and node not in reachable:
+                self._free_node(node)
+
+        logger.debug("rerooted tree, kept {} of {} nodes".format(len(self), size))
+        self._root = root
+
+    def _get_sparse_N(self, node: int) -> SparseN:
+        # only the legal children of the node can have visits
+        if self._N_edge[node] is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return self._action_indices[node], self._N_edge[node].astype(np.float64)
 
     def update(self, state: State, suppress_warning: bool = False) -> int:
-        if state not in self._fin:
-            if state.terminal:
-                self._fin[state] = state.outcome
-            else:
-                self._fin[state] = MCTS.CONTINUE
-
-        if self._fin[state] != MCTS.CONTINUE:
-            logger.debug("reached terminal with outcome {}".format(self._fin[state]))
-            return -self._fin[state]
-
-        if state not in self._nn_out: # not predicted yet, use only nn to find outcome
-            pi, v = self._nn.predict_pi_v(state)
-            valid_moves = state.legal_action_vector()
-            pi = pi.np_arr
-            pi_dist = np.multiply(valid_moves, pi)
-            pi_sum = np.sum(pi_dist)
-            if pi_sum > 0:
-                pi_dist /= pi_sum
-            else:
-                # if not suppress_warning:
-                #     logger.warn("pi_sum <= 0, it's ok just should not happen too much, will randomly select move now")
-                pi_dist += valid_moves
-                pi_dist /= np.sum(pi_dist)
+        return self._run_batch(self._get_node(state), 1, suppress_warning)
+
+    def _get_node(self, state: State) -> int:
+        node = self._node_index.get(state)
+        if node != None:
+            return node
+
+        if len(self._free) > 0:
+            node = self._free.pop()
+        else:
+            node = len(self._states)
+            for store in self._node_stores:
+                store.append(None)
+
+        self._node_index[state] = node
+        self._states[node] = state
+        self._fin[node] = state.outcome if state.terminal else MCTS.CONTINUE
+        self._N_node[node] = 0
+        return node
+
+    def _free_node(self, node: int):
+        del self._node_index[self._states[node]]
+        for store in self._node_stores:
+            store[node] = None
+        self._free.append(node)
+
+    def _get_child(self, node: int, slot: int) -> int:
+        child = self._children[node][slot]
+        if child < 0:
+            action = self._action_cls.from_flat_index(int(self._action_indices[node][slot]))
+            next_state = self._states[node].take_action(action)
+            child = self._get_node(next_state)
+            self._children[node][slot] = child
+
+        return int(child)
+
+    def _run_batch(self, root: int, batch_size: int, suppress_warning: bool = False) -> int:
+        # descends up to batch_size times, virtual loss steers each descent away from the
+        # paths already taken so the leaves can be sent to the nn as a single batch
+        pending: List[Tuple[int, Path]] = []
+        pending_nodes: Set[int] = set()
+        simulations = 0
+
+        for _ in range(batch_size):
+            leaf, path = self._select(root)
+
+            if leaf in pending_nodes:
+                # collided with a leaf already waiting on the nn, flush what we have
+                self._revert_virtual_loss(path)
+                break
+
+            simulations += 1
+
+            if self._fin[leaf] != MCTS.CONTINUE:
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug("reached terminal with outcome {}".format(self._fin[leaf]))
+                self._backup(path, -self._fin[leaf])
+                continue
 
-            self._nn_out[state] = self._game.get_PI_class().from_pi_dist(pi_dist)
-            self._valid[state] = valid_moves
-            self._N_node[state] = 0
-            return -v 
+            pending.append((leaf, path))
+            pending_nodes.add(leaf)
 
-        valid_moves = self._valid[state]
+        if len(pending) > 0:
+            outputs = self._evaluate([self._states[leaf] for leaf, _ in pending])
 
-        max_u = None
-        best_action = None
+            for (leaf, path), (priors, v) in zip(pending, outputs):
+                self._expand(leaf, priors, suppress_warning)
+                self._backup(path, -v)
 
-        n_num = np.sqrt(self._N_node[state])
-        n_num_eps = np.sqrt(self._N_node[state] + EPS)
-        pred_pi = self._nn_out[state]
+        return simulations
 
-        c = config["exploration_coefficient"]
+    def _evaluate(self, states: List[State]) -> List[Tuple[np.ndarray, float]]:
+        # priors over each state's legal actions and v, from the shared cache where possible,
+        # the rest goes to the nn as one batch
+        version = self._nn.version
+        outputs: List[Optional[Tuple[np.ndarray, float]]] = [None] * len(states)
+        misses = []
 
-        for action in state.get_legal_actions():
-            if (state, action) in self._EV_edge:
-                u = self._EV_edge[(state, action)] + c * pred_pi.p_of_a(action) * n_num / (1 + self._N_edge[(state,action)])
+        for i, state in enumerate(states):
+            entry = nn_cache.get((hash(state), version)) if nn_cache != None else None
+            if entry == None:
+                misses.append(i)
             else:
-                u = c * pred_pi.p_of_a(action) * n_num_eps
-            
-            if max_u == None or u > max_u:
-                max_u = u
-                best_action = action
+                outputs[i] = (entry[0].astype(np.float32), entry[1])
 
+        if len(misses) == 0:
+            return outputs
 
-        next_state = state.take_action(best_action)
-        v = self.update(next_state)
+        start = perf_counter() if metrics.enabled else 0
+        results = self._nn.predict_pi_v_batch([states[i] for i in misses])
 
-        if (state, best_action) in self._EV_edge:
-            self._EV_edge[(state, best_action)] = (
-                self._N_edge[(state, best_action)] * self._EV_edge[(state, best_action)] + v
-            ) / (self._N_edge[(state, best_action)] + 1)
+        if metrics.enabled:
+            metrics.add_time("inference", perf_counter() - start)
+            metrics.incr("nn_calls")
+            metrics.observe("nn_batch_size", len(misses))
 
-            self._N_edge[(state, best_action)] += 1
+        for i, (pi, v) in zip(misses, results):
+            # rounded to float16 whether or not it is cached so a hit expands the same as a miss
+            priors = pi.np_arr.ravel()[states[i].legal_action_indices()].astype(np.float16)
+            if nn_cache != None:
+                nn_cache.put((hash(states[i]), version), (priors, v))
+            outputs[i] = (priors.astype(np.float32), v)
 
+        return outputs
+
+    def _select(self, node: int) -> Tuple[int, Path]:
+        path: Path = []
+
+        while self._fin[node] == MCTS.CONTINUE and self._P[node] is not None:
+            slot = puct_argmax(self._Q_edge[node], self._cP[node], self._N_edge[node], self._N_node[node])
+            self._add_virtual_loss(node, slot)
+            path.append((node, slot))
+            node = self._get_child(node, slot)
+
+        return node, path
+
+    def _expand(self, node: int, priors: np.ndarray, suppress_warning: bool = False):
+        # priors are the policy at the legal actions of the node, they get renormalized
+        action_indices = self._states[node].legal_action_indices()
+
+        pi_sum = np.sum(priors)
+        if pi_sum > 0:
+            priors /= pi_sum
         else:
-            self._EV_edge[(state, best_action)] = 0
-            self._N_edge[(state, best_action)] = 1
+            # if not suppress_warning:
+            #     logger.warn("pi_sum <= 0, it's ok just should not happen too much, will randomly select move now")
+            priors[:] = 1 / len(action_indices)
+
+        self._action_indices[node] = action_indices
+        self._P[node] = priors
+        self._cP[node] = self._c * priors
+        self._N_edge[node] = np.zeros(len(action_indices), dtype=np.float32)
+        self._W_edge[node] = np.zeros(len(action_indices), dtype=np.float32)
+        self._Q_edge[node] = np.zeros(len(action_indices), dtype=np.float32)
+        self._children[node] = np.full(len(action_indices), -1, dtype=np.int32)
+        self._N_node[node] = 0
+
+    def _update_edge(self, node: int, slot: int, n: float, w: float):
+        # q is kept next to n and w so selection never divides
+        n_edge = self._N_edge[node]
+        w_edge = self._W_edge[node]
+        n_edge[slot] += n
+        w_edge[slot] += w
+        self._Q_edge[node][slot] = w_edge[slot] / n_edge[slot] if n_edge[slot] > 0 else 0
+        self._N_node[node] += n
+
+    def _add_virtual_loss(self, node: int, slot: int):
+        self._update_edge(node, slot, self._virtual_loss, -self._virtual_loss)
+
+    def _revert_virtual_loss(self, path: Path):
+        for node, slot in path:
+            self._update_edge(node, slot, -self._virtual_loss, self._virtual_loss)
+
+    def _backup(self, path: Path, v: float):
+        # v is from the point of view of the player moving into the leaf
+        self._revert_virtual_loss(path)
 
-        self._N_node[state] += 1
-        return -v
+        for node, slot in reversed(path):
+            self._update_edge(node, slot, 1, v)
+            v = -v
@@ -0,0 +1,122 @@
+import json
+from threading import Lock
+from time import time
+from typing import Any, Callable, Dict, Optional
+from config_loader import config
+
+class Metrics:
+    # process wide counters, value observations and timers, hot paths check enabled before
+    # calling in so a disabled registry costs one attribute lookup
+    #   counters       name -> count
+    #   observations   name -> (count, sum, max), batch sizes and the like
+    #   timers         name -> (count, total seconds)
+    #   collectors     name -> function returning a dict, read on every snapshot (cache stats)
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters: Dict[str, int] = {}
+            self._observations: Dict[str, list] = {}
+            self._timers: Dict[str, list] = {}
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            observation = self._observations.get(name)
+            if observation == None:
+                self._observations[name] = [1, value, value]
+            else:
+                observation[0] += 1
+                observation[1] += value
+                observation[2] = max(observation[2], value)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            timer = self._timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def get_count(self, name: str) -> int:
+        return self._counters.get(name, 0)
+
+    def get_seconds(self, name: str) -> float:
+        return self._timers.get(name, [0, 0.0])[1]
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, float]]):
+        self._collectors[name] = collector
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            out = {
+                "time": time(),
+                "counters": dict(self._counters),
+                "observations": {
+                    name: {"count": count, "sum": total, "mean": total / count, "max": maximum}
+                    for name, (count, total, maximum) in self._observations.items()
+                },
+                "timers": {
+                    name: {"count": count, "seconds": seconds}
+                    for name, (count, seconds) in self._timers.items()
+                }
+            }
+
+        out["collectors"] = {name: collector() for name, collector in self._collectors.items()}
+        return out
+
+    def to_prometheus(self, prefix: str = "alphazero") -> str:
+        snapshot = self.snapshot()
+        lines = []
+
+        def add(name: str, kind: str, value: float):
+            metric = "{}_{}".format(prefix, name).replace(".", "_")
+            lines.append("# TYPE {} {}".format(metric, kind))
+            lines.append("{} {}".format(metric, value))
+
+        for name, value in snapshot["counters"].items():
+            add(name + "_total", "counter", value)
+
+        for name, observation in snapshot["observations"].items():
+            add(name + "_count", "counter", observation["count"])
+            add(name + "_sum", "counter", observation["sum"])
+            add(name + "_max", "gauge", observation["max"])
+
+        for name, timer in snapshot["timers"].items():
+            add(name + "_count", "counter", timer["count"])
+            add(name + "_seconds_total", "counter", timer["seconds"])
+
+        for collector_name, values in snapshot["collectors"].items():
+            for name, value in values.items():
+                add(collector_name + "_" + name, "gauge", value)
+
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, file_path: str):
+        # appends one snapshot per line so a run leaves its history behind
+        with open(file_path, "a") as file:
+            file.write(json.dumps(self.snapshot()) + "\n")
+
+    def write_prometheus(self, file_path: str):
+        # written whole each time, the node exporter textfile collector picks it up
+        with open(file_path, "w") as file:
+            file.write(self.to_prometheus())
+
+    def export(self, file_path: str, format: Optional[str] = None):
+        # file_path is a name without extension, format is "json" or "prometheus"
+        if format == None:
+            format = config["metrics_format"]
+
+        if format == "json":
+            self.write_json(file_path + ".jsonl")
+        elif format == "prometheus":
+            self.write_prometheus(file_path + ".prom")
+        else:
+            raise ValueError("unknown metrics format '{}'".format(format))
+
+metrics = Metrics(config["metrics_enabled"])
@@ -1,7 +1,8 @@
-from abc import ABC, abstractproperty, abstractmethod
-from typing import List, Tuple
-from state import State
-from pi import PI
+from abc import abstractproperty, abstractmethod
+from functools import wraps
+from typing import Tuple
+from evaluator import Evaluator
+from replay_buffer import ReplayBuffer
 import numpy as np
 from os.path import join
 from logger import get_logger
@@ -11,8 +12,29 @@ logger = get_logger(__name__)
 TestTrainSplit = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
 XY = Tuple[np.ndarray, np.ndarray]
 
-class Model(ABC):
-    DataType = Tuple[List[State], Tuple[List[PI], List[float]]]
+class SpecMismatchError(ValueError):
+    # raised by load when the saved network has a different size than the one asked for
+    pass
+
+def _changes_weights(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.weights_changed()
+        return result
+
+    return wrapper
+
+class Model(Evaluator):
+    DataType = ReplayBuffer
+
+    def __init_subclass__(cls, **kwargs):
+        # train and load of every subclass give the model a new version once they return, the
+        # nn cache is keyed on it so outputs of the old weights are never served again
+        super().__init_subclass__(**kwargs)
+        for method_name in ["train", "load"]:
+            if method_name in cls.__dict__:
+                setattr(cls, method_name, _changes_weights(cls.__dict__[method_name]))
 
     @classmethod
     def from_file(cls, file_path: str, name: str):
@@ -20,10 +42,6 @@ class Model(ABC):
         new_model.load(file_path, name)
         return new_model
 
-    @abstractmethod
-    def predict_pi_v(self, state: State) -> Tuple[PI, float]:
-        pass
-
     @abstractproperty
     def name(self) -> str:
         pass
@@ -34,6 +52,7 @@ class Model(ABC):
 
     @abstractmethod
     def load(self, file_path: str, name: str):
+        # weights_changed is called after this returns, see __init_subclass__
         pass
 
     @abstractmethod
@@ -42,6 +61,18 @@ class Model(ABC):
 
     @abstractmethod
     def train(self, data: DataType):
+        # weights_changed is called after this returns, see __init_subclass__
+        pass
+
+    @staticmethod
+    def limit_threads(threads: int):
+        # called in each self play worker before its model is built, so that many workers
+        # do not each start a thread pool as wide as the machine
+        pass
+
+    def export_inference(self, file_path: str, name: str, calibration_data: DataType, eval_data: DataType):
+        # called after save, models with a faster reduced precision inference mode write it
+        # next to the saved model here so load can pick it up
         pass
 
     def get_file_name(self, model_name: str) -> str:
@@ -51,26 +82,10 @@ class Model(ABC):
         return join(file_path, self.get_file_name(model_name))
 
     def data_to_np(self, data: DataType, shuffle: bool = True) -> XY:
-        states, (pis, vs) = data
-        vs = np.array(vs)
-        pis = np.array(pis)
-        states = np.array(states)
-
-        logger.debug("shapes: {} {} {}".format(vs.shape, pis.shape, states.shape))
+        logger.debug("length {}".format(len(data)))
 
-        logger.debug("length {}".format(len(states)))
-
-
-        if shuffle:
-            perm = np.random.permutation(len(states))
-        else:
-            perm = np.arange(len(states))
-
-        states = np.array([state.get_nn_rep() for state in states[perm]])
-        pis = np.array([pi.np_arr for pi in pis[perm]])
-        vs = np.array(vs[perm]).reshape(len(vs), 1)
+        states, (pis, vs) = data.to_np(shuffle)
 
         logger.debug("shapes after shuffle and processing: {} {} {}".format(vs.shape, pis.shape, states.shape))
 
         return states, (pis, vs)
-
@@ -1,6 +1,7 @@
-from typing import Type
+from logging import DEBUG
+from typing import Tuple, Type, Union
 from action import Action
-from utils import multi_dim_argmax, multi_dim_argmax, multi_dim_random_choice
+from utils import format_multi_dim_index, multi_dim_argmax, multi_dim_argmax, multi_dim_random_choice
 
 from abc import ABC, abstractproperty, abstractstaticmethod
 import numpy as np
@@ -8,9 +9,18 @@ from logger import get_logger
 
 logger = get_logger(__name__)
 
+SparseN = Tuple[np.ndarray, np.ndarray] # (flat action indices, visit counts)
+
 class PI(ABC):
     @classmethod
-    def from_N_temp(cls, N: np.ndarray, tau: float) -> 'PI':
+    def from_N_temp(cls, N: Union[np.ndarray, SparseN], tau: float) -> 'PI':
+        indices = None
+        if isinstance(N, tuple):
+            indices, N = N
+            # keep ascending index order so ties break like the dense argmax
+            order = np.argsort(indices, kind="stable")
+            indices, N = indices[order], N[order]
+
         # for debugging only, so delete when done
         n_sum = np.sum(N)
 
@@ -26,15 +36,23 @@ class PI(ABC):
             denominator = np.sum(numerator)
 
             distrib = numerator / denominator
-            logger.debug("tau != 0, denom > 0 ({})".format(denominator))
+            if logger.isEnabledFor(DEBUG):
+                logger.debug("tau != 0, denom > 0 ({})".format(denominator))
 
         # logger.debug("sum of pi dist {}".format(np.sum(distrib)))
-        return cls.from_pi_dist(distrib)
+        if indices is None:
+            return cls.from_pi_dist(distrib)
+
+        return cls.from_sparse_dist(indices, distrib)
 
     @abstractstaticmethod
     def from_pi_dist(pi_dist: np.ndarray) -> 'PI':
         pass 
 
+    @abstractstaticmethod
+    def from_sparse_dist(indices: np.ndarray, probs: np.ndarray) -> 'PI':
+        pass
+
     @abstractproperty
     def shape(self) -> tuple:
         pass
@@ -50,4 +68,41 @@ class PI(ABC):
         return action_cls.from_action_tuple(multi_dim_argmax(self.np_arr))
 
     def p_of_a(self, action: Action) -> float:
-        return self.np_arr[action.action_tuple]
\ No newline at end of file
+        return self.np_arr[action.action_tuple]
+
+    def to_sparse(self) -> SparseN:
+        flat_pi = self.np_arr.ravel()
+        indices = np.flatnonzero(flat_pi)
+        return indices, flat_pi[indices]
+
+class SparsePI(PI, ABC):
+    # stores only the (flat index, prob) pairs of the nonzero entries, the dense array is
+    # rebuilt each time np_arr is read and never kept so a stored pi stays small
+    def __init__(self, indices: np.ndarray, probs: np.ndarray):
+        self._indices = np.asarray(indices, dtype=np.int32)
+        self._probs = np.asarray(probs, dtype=np.float32)
+
+    @property
+    def np_arr(self) -> np.ndarray:
+        dist = np.zeros(self.shape)
+        dist.flat[self._indices] = self._probs
+        return dist
+
+    def to_sparse(self) -> SparseN:
+        return self._indices, self._probs
+
+    def _flat_to_action(self, index: int, action_cls: Type[Action]) -> Action:
+        return action_cls.from_action_tuple(format_multi_dim_index(index, self.shape))
+
+    def get_rand_action(self, action_cls: Type[Action]) -> Action:
+        cumulative = np.cumsum(self._probs, dtype=np.float64)
+        i = np.searchsorted(cumulative, np.random.random() * cumulative[-1], side="right")
+        i = min(i, len(cumulative) - 1)
+        return self._flat_to_action(self._indices[i], action_cls)
+
+    def get_best_action(self, action_cls: Type[Action]) -> Action:
+        return self._flat_to_action(self._indices[np.argmax(self._probs)], action_cls)
+
+    def p_of_a(self, action: Action) -> float:
+        index = np.ravel_multi_index(action.action_tuple, self.shape)
+        return float(np.sum(self._probs[self._indices == index]))
\ No newline at end of file
@@ -0,0 +1,200 @@
+import json
+from logging import DEBUG
+from os import makedirs
+from os.path import join
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple, Type
+import numpy as np
+from numpy.lib.format import open_memmap
+from config_loader import config
+from logger import get_logger
+from pi import PI
+from state import State
+
+logger = get_logger(__name__)
+
+XY = Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray]]
+
+array_names = ["states", "pi_indices", "pi_probs", "vs"]
+meta_file_name = "replay.json"
+
+class ReplayBuffer:
+    # fixed size ring of training samples kept in preallocated arrays, once full the
+    # oldest sample is overwritten
+    #   state   state_cls.compact_rep_size() bytes (104 for chess)
+    #   pi      policy_slots (flat index, prob) pairs, uint16/int32 + float16
+    #   v       int8
+    # for chess with 128 policy slots that is 104 + 128 * (2 + 2) + 1 = 617 bytes a sample,
+    # so 100k samples take about 62mb
+    #
+    # on disk a buffer is a directory with one .npy file per array plus replay.json, opening
+    # it maps the files instead of reading them so it can be larger than memory
+    def __init__(self, capacity: int, state_cls: Type[State], action_shape: tuple, policy_slots: int = config["replay_policy_slots"]):
+        self._state_cls = state_cls
+        self._action_shape = action_shape
+        self._action_count = int(np.prod(action_shape))
+        self._file_path: Optional[str] = None
+
+        index_type = np.uint16 if self._action_count <= np.iinfo(np.uint16).max else np.int32
+        self._states = np.zeros((capacity, state_cls.compact_rep_size()), dtype=np.uint8)
+        self._pi_indices = np.zeros((capacity, policy_slots), dtype=index_type)
+        self._pi_probs = np.zeros((capacity, policy_slots), dtype=np.float16)
+        self._vs = np.zeros(capacity, dtype=np.int8)
+
+        self._next = 0
+        self._size = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def from_file(file_path: str, state_cls: Type[State], action_shape: tuple) -> 'ReplayBuffer':
+        with open(join(file_path, meta_file_name)) as file:
+            meta = json.load(file)
+
+        buffer = ReplayBuffer(0, state_cls, action_shape, meta["policy_slots"])
+
+        if meta["capacity"] > 0: # an empty file can not be mapped
+            arrays = [open_memmap(join(file_path, name + ".npy"), mode="r+") for name in array_names]
+            buffer._states, buffer._pi_indices, buffer._pi_probs, buffer._vs = arrays
+            buffer._file_path = file_path
+
+        buffer._next = meta["next"]
+        buffer._size = meta["size"]
+        logger.info("opened replay buffer {} with {} of {} samples".format(file_path, buffer._size, buffer.capacity))
+        return buffer
+
+    def save(self, file_path: str):
+        with self._lock:
+            arrays = [self._states, self._pi_indices, self._pi_probs, self._vs]
+
+            if file_path == self._file_path:
+                # already backed by these files, just make sure they are written out
+                for array in arrays:
+                    array.flush()
+            else:
+                makedirs(file_path, exist_ok=True)
+                for name, array in zip(array_names, arrays):
+                    np.save(join(file_path, name + ".npy"), array)
+
+            meta = {
+                "capacity": self.capacity,
+                "policy_slots": self._policy_slots,
+                "next": self._next,
+                "size": self._size
+            }
+
+            with open(join(file_path, meta_file_name), "w") as file:
+                json.dump(meta, file)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._vs)
+
+    @property
+    def _policy_slots(self) -> int:
+        return self._pi_indices.shape[1]
+
+    @property
+    def bytes_per_sample(self) -> int:
+        return self._states.itemsize * self._states.shape[1] \
+            + (self._pi_indices.itemsize + self._pi_probs.itemsize) * self._policy_slots \
+            + self._vs.itemsize
+
+    @property
+    def nbytes(self) -> int:
+        return self._states.nbytes + self._pi_indices.nbytes + self._pi_probs.nbytes + self._vs.nbytes
+
+    def _pack_sparse(self, sparse_pis: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        indices = np.zeros((len(sparse_pis), self._policy_slots), dtype=self._pi_indices.dtype)
+        probs = np.zeros((len(sparse_pis), self._policy_slots), dtype=np.float32)
+
+        for i, (pi_indices, pi_probs) in enumerate(sparse_pis):
+            if len(pi_indices) > self._policy_slots:
+                # keep the most visited moves, the rest of the mass is spread over them
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug("pi has {} entries, keeping the top {}".format(len(pi_indices), self._policy_slots))
+                top = np.argpartition(-pi_probs, self._policy_slots)[:self._policy_slots]
+                pi_indices = pi_indices[top]
+                pi_probs = pi_probs[top] / np.sum(pi_probs[top])
+
+            indices[i, :len(pi_indices)] = pi_indices
+            probs[i, :len(pi_probs)] = pi_probs
+
+        return indices, probs
+
+    def add(self, states: List[State], pis: List[PI], vs: List[float]):
+        capacity = self.capacity
+        if len(states) == 0 or capacity == 0:
+            return
+
+        # more samples than room, only the newest can survive anyway
+        states = states[-capacity:]
+        pis = pis[-capacity:]
+        vs = vs[-capacity:]
+
+        self.add_compact(self._state_cls.get_compact_reps(states), [pi.to_sparse() for pi in pis], vs)
+
+    def add_compact(self, compact: np.ndarray, sparse_pis: List[Tuple[np.ndarray, np.ndarray]], vs: List[float]):
+        # samples that were already packed, compact rows from get_compact_reps and the
+        # (indices, probs) of each pi, this is what self play workers send back
+        capacity = self.capacity
+        if len(compact) == 0 or capacity == 0:
+            return
+
+        compact = compact[-capacity:]
+        sparse_pis = sparse_pis[-capacity:]
+        vs = vs[-capacity:]
+
+        pi_indices, pi_probs = self._pack_sparse(sparse_pis)
+
+        with self._lock:
+            positions = (self._next + np.arange(len(compact))) % capacity
+            self._states[positions] = compact
+            self._pi_indices[positions] = pi_indices
+            self._pi_probs[positions] = pi_probs
+            self._vs[positions] = vs
+
+            self._next = (self._next + len(compact)) % capacity
+            self._size = min(self._size + len(compact), capacity)
+
+    def get(self, positions: np.ndarray) -> XY:
+        n = len(positions)
+
+        X = self._state_cls.nn_reps_from_compact(self._states[positions])
+
+        pis = np.zeros((n, self._action_count), dtype=np.float32)
+        # unused slots hold (0, 0) so they have to be added, not assigned
+        np.add.at(pis, (np.arange(n)[:, None], self._pi_indices[positions]), self._pi_probs[positions])
+        pis = pis.reshape((n,) + self._action_shape)
+
+        vs = self._vs[positions].astype(np.float32).reshape(n, 1)
+
+        return X, (pis, vs)
+
+    def sample(self, batch_size: int) -> XY:
+        # sorted so a mapped buffer is read front to back
+        return self.get(np.sort(np.random.randint(0, self._size, size=batch_size)))
+
+    def batches(self, batch_size: int, shuffle: bool = True, augment: bool = False) -> Iterator[XY]:
+        # one pass over the buffer, only a single minibatch is decoded at a time so memory
+        # does not grow with the buffer size, augment applies the game's symmetries
+        if shuffle:
+            positions = np.random.permutation(self._size)
+        else:
+            positions = np.arange(self._size)
+
+        for start in range(0, self._size, batch_size):
+            X, (pis, vs) = self.get(np.sort(positions[start:start + batch_size]))
+            if augment:
+                X, pis = self._state_cls.augment(X, pis)
+            yield X, (pis, vs)
+
+    def to_np(self, shuffle: bool = True) -> XY:
+        if shuffle:
+            positions = np.random.permutation(self._size)
+        else:
+            positions = np.arange(self._size)
+
+        return self.get(positions)
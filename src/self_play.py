@@ -0,0 +1,108 @@
+from multiprocessing import get_context
+from typing import Iterator, List, Optional, Tuple, Type
+import numpy as np
+from action import Action
+from game import Game
+from config_loader import config
+from logger import get_logger
+from mcts import MCTS
+from model import Model
+from pi import PI
+from state import State
+
+logger = get_logger(__name__)
+
+GameRecord = Tuple[List[State], List[PI], List[Action], List[int]]
+
+def play_game(mcts: MCTS, game: Type[Game], first_iter: bool = False) -> GameRecord:
+    state = game.get_state_class().from_root_state()
+    step_count = 0
+
+    states = []
+    pis = []
+    actions = []
+
+    while not state.terminal:
+
+        step_count += 1
+
+        tau = int(step_count < config["tau_threshold"])
+        pi: PI = mcts.get_pi(state, tau, first_iter)
+
+        states.append(state)
+        pis.append(pi)
+
+        action = pi.get_rand_action(game.get_action_class())
+        actions.append(action)
+        state = state.take_action(action) # state containts player
+
+    vs = []
+
+    v = state.outcome
+    for _ in range(len(states)):
+        vs.append(v)
+        v *= -1
+
+    return states, pis, actions, vs
+
+class CompactGame:
+    # what a worker sends back, already in the replay buffer's layout: one compact rep row per
+    # position plus the nonzero entries of each pi, so the parent only copies arrays
+    def __init__(self, compact: np.ndarray, sparse_pis: List[Tuple[np.ndarray, np.ndarray]], vs: np.ndarray):
+        self.compact = compact
+        self.sparse_pis = sparse_pis
+        self.vs = vs
+
+    @staticmethod
+    def from_game(game: Type[Game], states: List[State], pis: List[PI], vs: List[int]) -> 'CompactGame':
+        compact = game.get_state_class().get_compact_reps(states)
+        sparse_pis = []
+
+        for pi in pis:
+            indices, probs = pi.to_sparse()
+            sparse_pis.append((indices.astype(np.int32), probs.astype(np.float32)))
+
+        return CompactGame(compact, sparse_pis, np.array(vs, dtype=np.int8))
+
+    def __len__(self) -> int:
+        return len(self.vs)
+
+_worker_game: Optional[Type[Game]] = None
+_worker_model: Optional[Model] = None
+_worker_version: Optional[int] = None
+
+def _init_worker(game: Type[Game], threads: int):
+    global _worker_game
+    _worker_game = game
+    game.get_model_class().limit_threads(threads)
+
+def _play_episode(task: Tuple[int, str, str, bool]) -> CompactGame:
+    global _worker_model, _worker_version
+    version, file_path, name, first_iter = task
+
+    if version != _worker_version:
+        logger.debug("worker loading weights version {}".format(version))
+        _worker_model = _worker_game.get_model_class().from_file(file_path, name)
+        _worker_version = version
+
+    mcts = MCTS(_worker_model, _worker_game)
+    states, pis, _, vs = play_game(mcts, _worker_game, first_iter)
+    return CompactGame.from_game(_worker_game, states, pis, vs)
+
+class SelfPlayPool:
+    # each worker process holds its own copy of the model and plays whole games,
+    # so the pure python search is no longer serialized by the gil
+    def __init__(self, game: Type[Game], workers: int = config["self_play_workers"], threads: int = config["self_play_worker_threads"]):
+        # threads is the nn thread count of each worker, one per worker when there is a
+        # worker for every core
+        self._game = game
+        self._pool = get_context("spawn").Pool(workers, initializer=_init_worker, initargs=(game, threads))
+
+    def play(self, episodes: int, file_path: str, name: str, version: int, first_iter: bool = False) -> Iterator[CompactGame]:
+        # workers reload the weights saved under file_path/name whenever version changes
+        task = (version, file_path, name, first_iter)
+        return self._pool.imap_unordered(_play_episode, [task] * episodes)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
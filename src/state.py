@@ -1,10 +1,12 @@
 from abc import ABC, abstractproperty, abstractmethod, abstractstaticmethod
-from typing import Set
+from typing import List, Optional, Set, Tuple
 import numpy as np
 
 from action import Action
 
 class State(ABC):
+    __slots__ = ()
+
     @abstractstaticmethod
     def from_root_state() -> 'State':
         pass
@@ -25,6 +27,10 @@ class State(ABC):
     def get_legal_actions(self) -> Set[Action]:
         pass
 
+    def legal_action_indices(self) -> np.ndarray:
+        # flat indices into the action shape, games can override this with something faster
+        return np.array([action.flat_index for action in self.get_legal_actions()], dtype=np.int64)
+
     @abstractmethod
     def take_action(self, action: Action) -> 'State':
         pass
@@ -48,3 +54,39 @@ class State(ABC):
     @abstractmethod
     def get_nn_rep(self) -> np.ndarray:
         pass
+
+    @classmethod
+    def get_nn_reps(cls, states: List['State'], out: Optional[np.ndarray] = None) -> np.ndarray:
+        # fills a (len(states), *shape) buffer, games can override this with a batched encoder
+        if out is None:
+            out = np.empty((len(states),) + cls.get_shape(), dtype=np.float32)
+
+        for i, state in enumerate(states):
+            out[i] = state.get_nn_rep()
+        return out
+
+    # compact reps are fixed size uint8 rows that can be turned back into nn reps, the
+    # default just stores the nn rep as float16, games should override these with a real packing
+    @classmethod
+    def compact_rep_size(cls) -> int:
+        return int(np.prod(cls.get_shape())) * 2
+
+    @classmethod
+    def get_compact_reps(cls, states: List['State']) -> np.ndarray:
+        reps = cls.get_nn_reps(states).astype(np.float16)
+        return reps.reshape(len(states), -1).view(np.uint8)
+
+    @classmethod
+    def nn_reps_from_compact(cls, compact: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        reps = compact.view(np.float16).reshape((len(compact),) + cls.get_shape())
+        if out is None:
+            return reps.astype(np.float32)
+
+        out[...] = reps
+        return out
+
+    @classmethod
+    def augment(cls, nn_reps: np.ndarray, pis: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # applies random symmetries of the game to a batch of nn reps and their policy
+        # targets, in place, the default game has none
+        return nn_reps, pis
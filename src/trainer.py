@@ -1,117 +1,155 @@
+from os.path import join
 from sys import argv
+from time import perf_counter
 from typing import Type
 from threading import Thread
 from tqdm import tqdm
 from component_manager import ComponentManager
 from game import Game
 from config_loader import config
+from evaluator import Evaluator
+from inference_server import InferenceServer
 from logger import get_logger
-from model import Model
+from metrics import metrics
 from mcts import MCTS
-from pi import PI
 from game_runner import GameRunner
+from self_play import SelfPlayPool, play_game
 
 logger = get_logger(__name__)
 
 class Trainer:
     def __init__(self, game: Type[Game], file_path: str, load: bool = config["load_prev"]):
         self._component_manager = ComponentManager(game, file_path, load)
-        self._component_manager.add_model("base_nn", game.get_model_class()())
+        if not self._component_manager.has_model("base_nn"):
+            self._component_manager.add_model("base_nn", game.get_model_class()())
 
-    def _train_thread(self, nn: Model, game: Type[Game], first_iter: bool):
+    def _train_thread(self, nn: Evaluator, game: Type[Game], first_iter: bool):
         mcts = MCTS(nn, game)
-        new_data = self.run_game(mcts, first_iter)
-        for state, pi, v in new_data:
-            self._component_manager.add_data_point(state, pi, v)
+        states, pis, vs = zip(*self.run_game(mcts, first_iter))
+        self._component_manager.add_data_points(list(states), list(pis), list(vs))
 
     def self_play(self, iters: int):
         start_iter = self._component_manager.iterations
         final_iter = start_iter + iters
 
-        for _ in range(iters):
-            logger.info("starting iteration {}, out of {}".format(self._component_manager.iterations, final_iter))
+        pool = None
+        if config["self_play_workers"] > 0:
+            pool = SelfPlayPool(self._component_manager.game)
 
-            first_iter = self._component_manager.iterations == 0
+        try:
+            for _ in range(iters):
+                logger.info("starting iteration {}, out of {}".format(self._component_manager.iterations, final_iter))
 
-            nn = self._component_manager.get_model("base_nn")
-            game = self._component_manager.game
+                first_iter = self._component_manager.iterations == 0
 
-            mcts_threads = [Thread(target=self._train_thread, args=(nn, game, first_iter), daemon=True) for _ in range(config["episodes"])]
+                nn = self._component_manager.get_model("base_nn")
+                game = self._component_manager.game
+                stage_start = perf_counter()
 
-            for t in mcts_threads:
-                t.start()
+                if pool != None:
+                    # workers load the weights from disk, the previous iteration already saved
+                    # them unless this is the first one or the net changed since
+                    if not self._component_manager.is_saved("base_nn"):
+                        self._component_manager.save()
 
-            for t in tqdm(mcts_threads, desc="episodes"):
-                t.join()
+                    games = pool.play(
+                        config["episodes"], 
+                        self._component_manager.file_path, 
+                        "base_nn", 
+                        self._component_manager.iterations, 
+                        first_iter
+                    )
 
-            logger.info("finished self play, training now...")
-                
-
-            prev_nn = nn.clone()
-            nn.train(
-                self._component_manager.get_data_set(True), 
-                self._component_manager.get_data_set(False)
-            )
-
-            logger.info("comparing prev nn with new")
+                    for compact_game in tqdm(games, total=config["episodes"], desc="episodes"):
+                        self._component_manager.add_compact_data_points(compact_game.compact, compact_game.sparse_pis, compact_game.vs)
 
-            game_runner: GameRunner = GameRunner.from_nns(nn, prev_nn, self._component_manager.game)
+                else:
+                    server = InferenceServer(nn)
+                    server.start()
 
-            if config["side_advantage"]:
-                side_1_dict = game_runner.best_of(config["competition_amount"], 0)
-                side_1 = GameRunner.dict_to_win_frac(side_1_dict)
+                    mcts_threads = [Thread(target=self._train_thread, args=(server, game, first_iter), daemon=True) for _ in range(config["episodes"])]
 
-                side_2_dict = game_runner.best_of(config["competition_amount"], 1)
-                side_2 = GameRunner.dict_to_win_frac(side_2_dict)
+                    for t in mcts_threads:
+                        t.start()
 
-                if side_1 > side_2:
-                    logger.info("new nn is better {}".format(side_1_dict))
-                elif side_2 > side_1:
-                    logger.info("old nn was better {}".format(side_2_dict))
-                else:
-                    logger.info("neither nn was better")
-
-            else:
-                win_dict = game_runner.best_of(config["competition_amount"])
-                win_frac = GameRunner.dict_to_win_frac(win_dict)
-                if win_frac == 0:
-                    logger.info("neither nn was better")
-                elif win_frac > 0.5:
-                    logger.info("new nn is better {}".format(win_dict))
-                else:
-                    logger.info("old nn was better {} (inverted: losses -> old nn wins)".format(win_dict))
+                    for t in tqdm(mcts_threads, desc="episodes"):
+                        t.join()
 
+                    server.stop()
+                    logger.info("inference stats {}".format(server.stats()))
 
-            self._component_manager.increment_iter()
-            self._component_manager.save()
+                stage_start = self._end_stage("self_play", stage_start)
+                logger.info("finished self play, training now...")
+                
 
+                prev_nn = nn.clone()
+                nn.train(
+                    self._component_manager.get_data_set(True), 
+                    self._component_manager.get_data_set(False)
+                )
 
-    def run_game(self, mcts: MCTS, first_iter: bool = False):
-        state = self._component_manager.game.get_state_class().from_root_state()
-        step_count = 0
+                stage_start = self._end_stage("training", stage_start)
+                logger.info("comparing prev nn with new")
 
-        states = []
-        pis = []
+                game_runner: GameRunner = GameRunner.from_nns(nn, prev_nn, self._component_manager.game)
+                best_of = game_runner.best_of_parallel if config["arena_parallel_games"] > 1 else game_runner.best_of
 
-        while not state.terminal:
+                if config["arena_mode"] == "sprt":
+                    sprt_dict = game_runner.sprt()
+                    game_times = sprt_dict["game_times"]
+                    logger.info("sprt decided the new nn is {} {}".format(sprt_dict["decision"], sprt_dict))
 
-            step_count += 1
+                    # the test usually stops at the game cap with nothing decided, early nets
+                    # mostly draw, so then the new net is kept unless it lost more than it won
+                    if sprt_dict["decision"] == "worse" or (sprt_dict["decision"] == "inconclusive" and GameRunner.dict_to_win_frac(sprt_dict) < 0):
+                        self._component_manager.rollback_model("base_nn", prev_nn)
 
-            tau = int(step_count < config["tau_threshold"])
-            pi: PI = mcts.get_pi(state, tau, first_iter)
+                elif config["side_advantage"]:
+                    side_1_dict = best_of(config["competition_amount"], 0)
+                    side_1 = GameRunner.dict_to_win_frac(side_1_dict)
 
-            states.append(state)
-            pis.append(pi)
+                    side_2_dict = best_of(config["competition_amount"], 1)
+                    side_2 = GameRunner.dict_to_win_frac(side_2_dict)
 
-            action = pi.get_rand_action(self._component_manager.game.get_action_class())
-            state = state.take_action(action) # state containts player
+                    game_times = side_1_dict["game_times"] + side_2_dict["game_times"]
 
-        vs = []
+                    if side_1 > side_2:
+                        logger.info("new nn is better {}".format(side_1_dict))
+                    elif side_2 > side_1:
+                        logger.info("old nn was better {}".format(side_2_dict))
+                    else:
+                        logger.info("neither nn was better")
 
-        v = state.outcome
-        for _ in range(len(states)):
-            vs.append(v)
-            v *= -1
+                else:
+                    win_dict = best_of(config["competition_amount"])
+                    win_frac = GameRunner.dict_to_win_frac(win_dict)
+                    game_times = win_dict["game_times"]
+
+                    if win_frac == 0:
+                        logger.info("neither nn was better")
+                    elif win_frac > 0.5:
+                        logger.info("new nn is better {}".format(win_dict))
+                    else:
+                        logger.info("old nn was better {} (inverted: losses -> old nn wins)".format(win_dict))
+
+                logger.info("played {} arena games, {:.1f}s a game".format(len(game_times), sum(game_times) / max(len(game_times), 1)))
+                self._end_stage("arena", stage_start)
+
+                self._component_manager.increment_iter()
+                self._component_manager.save()
+
+                if metrics.enabled:
+                    metrics.export(join(self._component_manager.file_path, "metrics"))
+        finally:
+            if pool != None:
+                pool.close()
+
+    def _end_stage(self, name: str, start: float) -> float:
+        end = perf_counter()
+        if metrics.enabled:
+            metrics.add_time(name, end - start)
+        return end
 
+    def run_game(self, mcts: MCTS, first_iter: bool = False):
+        states, pis, _, vs = play_game(mcts, self._component_manager.game, first_iter)
         return zip(states, pis, vs)
-                
\ No newline at end of file
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Optional
+
+class TranspositionTable:
+    # bounded map from a 64 bit position key to a value, least recently used entries are
+    # evicted first, every method holds the lock so self play threads can share one table
+    def __init__(self, max_entries: int):
+        if max_entries <= 0:
+            raise ValueError("transposition table needs room for at least one entry")
+
+        self._entries: OrderedDict = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: int) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: int, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def max_entries(self) -> int:
+        return self._max_entries
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self._max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": self._hits / lookups if lookups > 0 else 0.0
+            }